@@ -27,13 +27,15 @@ import base64
 import socket
 import struct
 import ssl
-import time
 import sys
 import errno
 import logging
 from BaseHTTPServer import BaseHTTPRequestHandler
 from StringIO import StringIO
-from select import select
+import select
+import collections
+import binascii
+import zlib
 
 
 class HTTPRequest(BaseHTTPRequestHandler):
@@ -50,7 +52,8 @@ class WebSocket(object):
       "HTTP/1.1 101 Switching Protocols\r\n"
       "Upgrade: WebSocket\r\n"
       "Connection: Upgrade\r\n"
-      "Sec-WebSocket-Accept: %(acceptstr)s\r\n\r\n"
+      "Sec-WebSocket-Accept: %(acceptstr)s\r\n"
+      "%(extensions)s\r\n"
    )
    
    hixiehandshakedStr = (
@@ -70,12 +73,9 @@ class WebSocket(object):
    PING = 0x9
    PONG = 0xA
 
-   HEADERB1 = 1
-   HEADERB2 = 3
-   LENGTHSHORT = 4
-   LENGTHLONG = 5
-   MASK = 6
-   PAYLOAD = 7
+   # what to do with a client whose send buffer is over the high-water mark
+   SENDDROP = 0         # drop droppable frames, disconnect if the rest reaches 4x the mark
+   SENDDISCONNECT = 1   # disconnect straight away
 
    def __init__(self, server, sock, address):
       self.server = server
@@ -93,22 +93,48 @@ class WebSocket(object):
       self.data = None
       self.opcode = 0
       self.hasmask = 0
-      self.maskarray = None
       self.length = 0
-      self.lengtharray = None
-      self.index = 0
       self.request = None
       self.usingssl = False
 
-      self.state = self.HEADERB1
+      # received bytes not yet parsed into complete frames
+      self.framebuffer = bytearray()
    
       # restrict the size of header and payload for security reasons
       self.maxheader = 65536
       self.maxpayload = 4194304
 
+      # frames waiting for the socket to become writable, as [frame, droppable]
+      self.sendq = collections.deque()
+      self.sendqbytes = 0
+      self.sendindex = 0      # bytes of the first frame already sent
+      self.waitingwrite = False
+
+      # bound how far a slow client can fall behind (set on the server, see SimpleWebSocketServer)
+      self.maxsendbuffer = server.maxsendbuffer
+      self.sendpolicy = server.sendpolicy
+
+      # permessage-deflate, set up in the handshake if the server and client both want it
+      self.deflate = None     # negotiated (window bits, context takeover)
+      self.compressor = None
+      self.decompressor = None
+
    def close(self):
+      # last chance for anything queued (such as a close frame)
+      try:
+         self.flush()
+      except:
+         pass
+
       self.client.close()
-      self.state = self.HEADERB1
+      self.sendq.clear()
+      self.sendqbytes = 0
+      self.sendindex = 0
+      self.waitingwrite = False
+      self.framebuffer = bytearray()
+      self.deflate = None
+      self.compressor = None
+      self.decompressor = None
       self.hasmask = False
       self.handshaked = False
       self.readdraftkey = False
@@ -195,15 +221,23 @@ class WebSocket(object):
                # handshake rfc 6455
                elif self.request.headers.has_key('Sec-WebSocket-Key'.lower()):
                   key = self.request.headers['Sec-WebSocket-Key'.lower()]
-                  hStr = self.handshakeStr % { 'acceptstr' :  base64.b64encode(hashlib.sha1(key + self.GUIDStr).digest()) }
+                  extensions = self.negotiateDeflate(self.request.headers.get('Sec-WebSocket-Extensions'.lower()))
+                  if extensions is not None:
+                     extensions = 'Sec-WebSocket-Extensions: %s\r\n' % extensions
+                  hStr = self.handshakeStr % { 'acceptstr' :  base64.b64encode(hashlib.sha1(key + self.GUIDStr).digest()), 'extensions' : extensions or '' }
                   self.sendBuffer(hStr)
                   self.handshaked = True
+                  # keep any frames that arrived with the header
+                  self.framebuffer.extend(self.headerbuffer[self.headerbuffer.find('\r\n\r\n') + 4:])
                   self.headerbuffer = ''
                   
                   try:
                      self.handleConnected()
                   except:
                      pass		
+
+                  if self.framebuffer:
+                     self.parseFrames()
                else:
                   raise Exception('Sec-WebSocket-Key does not exist')
 
@@ -213,13 +247,13 @@ class WebSocket(object):
             
       # else do normal data		
       else:
-         data = self.client.recv(2048)
+         data = self.client.recv(8192)
          if data:
-            for val in data:
-               if self.hixie76 is False:
-                  self.parseMessage(ord(val))
-               else:
-                  self.parseMessage_hixie76(ord(val))
+            self.framebuffer.extend(data)
+            if self.hixie76 is False:
+               self.parseFrames()
+            else:
+               self.parseFrames_hixie76()
          else:
             raise Exception("remote socket closed")
    
@@ -269,41 +303,191 @@ class WebSocket(object):
       else:
          pass
 
-   def sendBuffer(self, buff):
-      size = len(buff)
-      tosend = size
-      index = 0
-
-      while tosend > 0:
+   # queue a buffer to be sent without blocking, frames that can be dropped
+   # when the client falls behind are marked droppable
+   def sendBuffer(self, buff, droppable=False):
+      # frames are sent as immutable strings so they can be shared between connections
+      if not isinstance(buff, str):
+         buff = str(buff)
+
+      if self.sendqbytes + len(buff) > self.maxsendbuffer:
+         if self.sendpolicy == self.SENDDISCONNECT:
+            raise Exception('send buffer exceeded high-water mark')
+
+         # stale droppable frames go first, then the new one if there is still no room
+         self.dropFrames()
+         if self.sendqbytes + len(buff) > self.maxsendbuffer:
+            if droppable:
+               return
+            if self.sendqbytes + len(buff) > self.maxsendbuffer * 4:
+               raise Exception('send buffer exceeded allowable size')
+
+      self.sendq.append([buff, droppable])
+      self.sendqbytes += len(buff)
+
+      # nothing else waiting so try to send it now
+      if len(self.sendq) == 1:
+         self.flush()
+
+   # remove droppable frames that have not started sending
+   def dropFrames(self):
+      kept = collections.deque()
+      for index, frame in enumerate(self.sendq):
+         if frame[1] is False or (index == 0 and self.sendindex > 0):
+            kept.append(frame)
+         else:
+            self.sendqbytes -= len(frame[0])
+      self.sendq = kept
+
+   # send as much of the queue as the socket will take, called again by the
+   # server when the socket is writable. returns True once the queue is empty
+   def flush(self):
+      while self.sendq:
+         buff = self.sendq[0][0]
          try:
-            # i should be able to send a bytearray
-            sent = self.client.send(str(buff[index:size]))
+            sent = self.client.send(buff[self.sendindex:] if self.sendindex else buff)
             if sent == 0:
                raise RuntimeError("socket connection broken")
 
-            index += sent
-            tosend -= sent
-
          except socket.error as e:
-            # if we have full buffers then wait for them to drain and try again
-            if e.errno == errno.EAGAIN:
-               time.sleep(0.001)
+            # full buffers, wait until the socket is writable
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+               break
+            elif isinstance(e, ssl.SSLError) and e.args[0] in (ssl.SSL_ERROR_WANT_WRITE, ssl.SSL_ERROR_WANT_READ):
+               break
             else:
                raise e
 
-   
-   #if s is a string then websocket TEXT is sent else BINARY
-   def sendMessage(self, s):
-      
+         self.sendindex += sent
+         if self.sendindex < len(buff):
+            break
+
+         self.sendq.popleft()
+         self.sendqbytes -= len(buff)
+         self.sendindex = 0
+
+      # only ask the server to watch for writability while something is waiting
+      waiting = len(self.sendq) > 0
+      if waiting != self.waitingwrite:
+         self.waitingwrite = waiting
+         self.server.waitForWrite(self, waiting)
+
+      return not waiting
+
+   # accept the first permessage-deflate offer (rfc 7692) we can support,
+   # returning the extension response or None to carry on uncompressed
+   def negotiateDeflate(self, offers):
+      if not offers or self.server.deflatelevel <= 0:
+         return None
+
+      for offer in offers.split(','):
+         params = [param.strip() for param in offer.split(';')]
+         if params[0] != 'permessage-deflate':
+            continue
+
+         wbits = None
+         takeover = self.server.deflatecontexttakeover
+         accepted = True
+         for param in params[1:]:
+            name, _, value = param.partition('=')
+            name = name.strip()
+            value = value.strip().strip('"')
+
+            if name == 'server_no_context_takeover' and not value:
+               takeover = False
+            # zlib can't compress with a 256 byte window
+            elif name == 'server_max_window_bits' and value.isdigit() and 9 <= int(value) <= 15:
+               wbits = int(value)
+            # incoming messages are inflated with the largest window, which suits any client
+            elif name == 'client_no_context_takeover' and not value:
+               pass
+            elif name == 'client_max_window_bits' and (not value or value.isdigit() and 8 <= int(value) <= 15):
+               pass
+            else:
+               accepted = False
+               break
+
+         if accepted is False:
+            continue
+
+         response = 'permessage-deflate'
+         if takeover is False:
+            response += '; server_no_context_takeover'
+         if wbits is not None:
+            response += '; server_max_window_bits=%d' % wbits
+
+         self.deflate = (wbits or 15, takeover)
+         self.decompressor = zlib.decompressobj(-15)
+         return response
+
+      return None
+
+   # compress a payload as one permessage-deflate message, without the
+   # 00 00 ff ff that ends every sync flush
+   def deflatePayload(self, s):
+      wbits, takeover = self.deflate
+      compressor = self.compressor
+      if compressor is None:
+         compressor = zlib.compressobj(self.server.deflatelevel, zlib.DEFLATED, -wbits)
+         if takeover is True:
+            self.compressor = compressor
+
+      data = compressor.compress(str(s)) + compressor.flush(zlib.Z_SYNC_FLUSH)
+      return data[:-4]
+
+   def inflatePayload(self, data):
+      if self.decompressor is None:
+         raise Exception('compressed frame without permessage-deflate')
+
+      data = self.decompressor.decompress(str(data) + '\x00\x00\xff\xff', self.maxpayload)
+      # if length exceeds allowable size then we except and remove the connection
+      if self.decompressor.unconsumed_tail:
+         raise Exception('payload exceeded allowable size')
+      return bytearray(data)
+
+   # connections with the same key are sent the same payload for a message,
+   # so a broadcast only has to encode it once
+   def payloadKey(self):
+      return None
+
+   # the payload to send for a message, a str is sent as TEXT else BINARY
+   def encodePayload(self, message):
+      if not isinstance(message, (str, bytearray)):
+         message = str(message)
+      return message
+
+   # connections with the same key are sent identical frames for the same
+   # payload, so a broadcast only has to build each frame once. None means
+   # the frames can't be shared (they are compressed against earlier ones)
+   def frameKey(self):
+      if self.deflate is None:
+         return self.hixie76
+
+      wbits, takeover = self.deflate
+      if takeover is True:
+         return None
+      return ('deflate', wbits)
+
+   #if s is a string then websocket TEXT is built else BINARY
+   def encodeFrame(self, s):
+      if not isinstance(s, (str, bytearray)):
+         s = str(s)
+
       if self.hixie76 is False:
 
          header = bytearray()
          isString = isinstance(s, str)
 
+         # rsv1 marks a compressed message
+         rsv = 0
+         if self.deflate is not None and len(s) >= self.server.deflatemin:
+            s = self.deflatePayload(s)
+            rsv = 0x40
+
          if isString is True: 
-            header.append(0x81)
+            header.append(0x81 | rsv)
          else:
-            header.append(0x82)
+            header.append(0x82 | rsv)
 
          b2 = 0		
          length = len(s)
@@ -323,10 +507,9 @@ class WebSocket(object):
             header.extend(struct.pack("!Q", length))
 
          if length > 0:
-            self.sendBuffer(header + s) 
+            return str(header) + str(s)
          else:
-            self.sendBuffer(header)
-         header = None
+            return str(header)
 
       else:
          msg = bytearray()			
@@ -335,186 +518,211 @@ class WebSocket(object):
             msg.extend(str(s).encode("UTF8"))
          msg.append(0xFF)
 
-         self.sendBuffer(msg)
-         msg = None
-
-
-   def parseMessage_hixie76(self, byte):
+         return str(msg)
 
-      if self.state == self.HEADERB1:
-         if byte == 0:
-            self.state = self.PAYLOAD
-            self.data = bytearray()
-
-      elif self.state == self.PAYLOAD:
-         if byte == 0xFF:
-            self.opcode = 1
-            self.length = len(self.data)
-            try:
-               self.handlePacket()
-            finally:
-               self.data = None
-               self.state = self.HEADERB1
-         else	:
-            self.data.append(byte)
+   #if s is a string then websocket TEXT is sent else BINARY
+   def sendMessage(self, s, droppable=False):
+      self.sendPayload(self.encodePayload(s), droppable)
+
+   # frame and queue a payload for this connection alone
+   def sendPayload(self, payload, droppable=False):
+      if self.deflate is not None and self.deflate[1] is True:
+         # once compressed into the shared context a frame has to be sent,
+         # so a droppable one is skipped before it is built if the client is behind
+         if droppable and self.sendqbytes >= self.maxsendbuffer:
+            return
+         droppable = False
+
+      self.sendBuffer(self.encodeFrame(payload), droppable)
+
+
+   # xor a whole payload with the repeated 4 byte mask in one big integer operation
+   @staticmethod
+   def unmask(mask, payload):
+      length = len(payload)
+      if length == 0:
+         return bytearray()
+      key = (mask * (length // 4 + 1))[:length]
+      value = int(binascii.hexlify(payload), 16) ^ int(binascii.hexlify(key), 16)
+      return bytearray(binascii.unhexlify('%0*x' % (length * 2, value)))
+
+   def parseFrames_hixie76(self):
+      buff = self.framebuffer
+      while True:
+         # frames are 0x00, utf-8 data, 0xFF
+         start = buff.find('\x00')
+         if start < 0:
+            del buff[:]
+            return
+
+         end = buff.find('\xff', start + 1)
+         if end < 0:
             # if length exceeds allowable size then we except and remove the connection
-            if len(self.data) >= self.maxpayload:
+            if len(buff) - start >= self.maxpayload:
                raise Exception('payload exceeded allowable size')
+            del buff[:start]
+            return
 
+         self.opcode = 1
+         self.data = buff[start + 1:end]
+         self.length = len(self.data)
+         del buff[:end + 1]
+         try:
+            self.handlePacket()
+         finally:
+            self.data = None
+
+   # handle every complete frame in the buffer, decoding each header in one
+   # step and unmasking each payload at once, and keep any partial frame
+   def parseFrames(self):
+      buff = self.framebuffer
+      offset = 0
+      try:
+         while True:
+            available = len(buff) - offset
+            if available < 2:
+               break
+
+            b1 = buff[offset]
+            b2 = buff[offset + 1]
+            length = b2 & 0x7F
+            header = 2
+
+            if length == 126:
+               if available < 4:
+                  break
+               length = struct.unpack_from('!H', buff, offset + 2)[0]
+               header = 4
+            elif length == 127:
+               if available < 10:
+                  break
+               length = struct.unpack_from('!Q', buff, offset + 2)[0]
+               header = 10
 
-   def parseMessage(self, byte):	
-      # read in the header
-      if self.state == self.HEADERB1:
-         # fin
-         self.fin = (byte & 0x80)
-         # get opcode
-         self.opcode = (byte & 0x0F)
-         
-         self.state = self.HEADERB2
-      
-      elif self.state == self.HEADERB2:
-         mask = byte & 0x80				
-         length = byte & 0x7F
-         
-         if mask == 128:
-            self.hasmask = True
-         else:
-            self.hasmask = False
-         
-         if length <= 125:
-            self.length = length
-            
-            # if we have a mask we must read it
-            if self.hasmask is True:
-               self.maskarray = bytearray()
-               self.state = self.MASK
-            else:
-               # if there is no mask and no payload we are done
-               if self.length <= 0:
-                  try:
-                     self.handlePacket()
-                  finally:
-                     self.state = self.HEADERB1
-                     self.data = None
-                     
-               # we have no mask and some payload
-               else:
-                  self.index = 0
-                  self.data = bytearray()
-                  self.state = self.PAYLOAD
-               
-         elif length == 126:
-            self.lengtharray = bytearray()
-            self.state = self.LENGTHSHORT
-            
-         elif length == 127:
-            self.lengtharray = bytearray()
-            self.state = self.LENGTHLONG
+            # if length exceeds allowable size then we except and remove the connection
+            if length >= self.maxpayload:
+               raise Exception('payload exceeded allowable size')
 
-      
-      elif self.state == self.LENGTHSHORT:
-         self.lengtharray.append(byte)
+            hasmask = b2 & 0x80 == 128
+            if hasmask:
+               header += 4
 
-         if len(self.lengtharray) > 2:
-            raise Exception('short length exceeded allowable size')
+            if available < header + length:
+               break
 
-         if len(self.lengtharray) == 2:
-            self.length = struct.unpack_from('!H', str(self.lengtharray))[0]
-            
-            if self.hasmask is True:
-               self.maskarray = bytearray()
-               self.state = self.MASK
-            else:
-               # if there is no mask and no payload we are done
-               if self.length <= 0:
-                  try:
-                     self.handlePacket()
-                  finally:
-                     self.state = self.HEADERB1
-                     self.data = None
+            start = offset + header
+            self.fin = b1 & 0x80
+            self.opcode = b1 & 0x0F
+            self.hasmask = hasmask
+            self.length = length
+            offset = start + length
 
-               # we have no mask and some payload
+            # no payload leaves data as None
+            if length > 0:
+               if hasmask:
+                  self.data = self.unmask(buff[start - 4:start], buff[start:start + length])
                else:
-                  self.index = 0
-                  self.data = bytearray()
-                  self.state = self.PAYLOAD
-         
-      elif self.state == self.LENGTHLONG:
+                  self.data = buff[start:start + length]
 
-         self.lengtharray.append(byte)
+               # rsv1 marks a compressed message
+               if b1 & 0x40:
+                  self.data = self.inflatePayload(self.data)
 
-         if len(self.lengtharray) > 8:
-            raise Exception('long length exceeded allowable size')
+            try:
+               self.handlePacket()
+            finally:
+               self.data = None
+      finally:
+         del buff[:offset]
 
-         if len(self.lengtharray) == 8:
-            self.length = struct.unpack_from('!Q', str(self.lengtharray))[0]
 
-            if self.hasmask is True:
-               self.maskarray = bytearray()
-               self.state = self.MASK
-            else:
-               # if there is no mask and no payload we are done
-               if self.length <= 0:
-                  try:
-                     self.handlePacket()
-                  finally:
-                     self.state = self.HEADERB1
-                     self.data = None
+class Poller(object):
+# Andrew Palmer (Github AndyP123):
+#   readiness notification for the server loop, using epoll where available
+#   (linux), then poll, then select. events are reported with the READ, WRITE
+#   and ERROR flags below whichever implementation is used
+   READ = 0x001            # EPOLLIN / POLLIN
+   WRITE = 0x004           # EPOLLOUT / POLLOUT
+   ERROR = 0x008 | 0x010   # EPOLLERR | EPOLLHUP / POLLERR | POLLHUP
+
+   def __init__(self):
+      if hasattr(select, 'epoll'):
+         self.poller = select.epoll()
+         self.scale = 1.0
+      elif hasattr(select, 'poll'):
+         self.poller = select.poll()
+         self.scale = 1000.0
+      else:
+         self.poller = None
+         self.readers = set()
+         self.writers = set()
 
-               # we have no mask and some payload
-               else:
-                  self.index = 0
-                  self.data = bytearray()
-                  self.state = self.PAYLOAD
-         
-      # MASK STATE
-      elif self.state == self.MASK:
-         self.maskarray.append(byte)
-
-         if len(self.maskarray) > 4:
-            raise Exception('mask exceeded allowable size')
-
-         if len(self.maskarray) == 4:
-            # if there is no mask and no payload we are done
-            if self.length <= 0:
-               try:
-                  self.handlePacket()
-               finally:
-                  self.state = self.HEADERB1
-                  self.data = None
-                  
-            # we have no mask and some payload
-            else:
-               self.index = 0
-               self.data = bytearray()
-               self.state = self.PAYLOAD
-      
-      # PAYLOAD STATE
-      elif self.state == self.PAYLOAD:
-         if self.hasmask is True:
-            self.data.append( byte ^ self.maskarray[self.index % 4] )
-         else:
-            self.data.append( byte )
+   # can the poller wait on pipes as well as sockets (not on windows)
+   def canPollPipes(self):
+      return self.poller is not None
 
-         # if length exceeds allowable size then we except and remove the connection
-         if len(self.data) >= self.maxpayload:
-            raise Exception('payload exceeded allowable size')
+   def register(self, fileno, events):
+      if self.poller is not None:
+         self.poller.register(fileno, events)
+      else:
+         self.modify(fileno, events)
 
-         # check if we have processed length bytes; if so we are done
-         if (self.index+1) == self.length:
-            try:
-               self.handlePacket()
-            finally:
-               self.state = self.HEADERB1
-               self.data = None
+   def modify(self, fileno, events):
+      if self.poller is not None:
+         self.poller.modify(fileno, events)
+      else:
+         self.readers.discard(fileno)
+         self.writers.discard(fileno)
+         if events & self.READ:
+            self.readers.add(fileno)
+         if events & self.WRITE:
+            self.writers.add(fileno)
+
+   def unregister(self, fileno):
+      if self.poller is not None:
+         try:
+            self.poller.unregister(fileno)
+         except (KeyError, IOError, OSError, ValueError):
+            pass
+      else:
+         self.readers.discard(fileno)
+         self.writers.discard(fileno)
+
+   # returns a list of (fileno, events), timeout in seconds (None blocks)
+   def poll(self, timeout=None):
+      if self.poller is not None:
+         if timeout is None:
+            timeout = -1
          else:
-            self.index += 1
+            timeout = timeout * self.scale
+         while True:
+            try:
+               return self.poller.poll(timeout)
+            except (IOError, OSError, select.error) as e:
+               # interrupted by a signal, try again
+               if e.args[0] != errno.EINTR:
+                  raise
+
+      rList, wList, xList = select.select(list(self.readers), list(self.writers), list(self.readers), timeout)
+      events = {}
+      for fileno in rList:
+         events[fileno] = events.get(fileno, 0) | self.READ
+      for fileno in wList:
+         events[fileno] = events.get(fileno, 0) | self.WRITE
+      for fileno in xList:
+         events[fileno] = events.get(fileno, 0) | self.ERROR
+      return events.items()
+
+   def close(self):
+      if self.poller is not None:
+         self.poller.close()
 
 
 class SimpleWebSocketServer(object):
 # Andrew Palmer (Github AndyP123):
 #   added message_queue (multiprocessing.Queue) to ease sending messages to all
-#   connected clients
+#   connected clients. the server loop waits on the queue's pipe as well as the
+#   sockets, so queued messages are sent as soon as they arrive
    def __init__(self, host, port, websocketclass, message_queue=None):
       self.websocketclass = websocketclass
       self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -522,9 +730,44 @@ class SimpleWebSocketServer(object):
       self.serversocket.bind((host, port))
       self.serversocket.listen(5)
       self.connections = {}
-      self.listeners = [self.serversocket]
       self.message_queue = message_queue
 
+      # permessage-deflate is offered to clients at deflatelevel 1 (fastest) to 9 (smallest), 0 turns it off.
+      # with context takeover each client's messages are compressed against the ones before (smaller
+      # frames, but compressed per client), without it one compressed frame is shared by every client
+      self.deflatelevel = 0
+      self.deflatemin = 64    # shorter payloads are sent uncompressed
+      self.deflatecontexttakeover = True
+
+      # each client's send buffer high-water mark in bytes, and what happens to a client over it
+      # (WebSocket.SENDDROP or SENDDISCONNECT). taken by connections as they are accepted
+      self.maxsendbuffer = 262144
+      self.sendpolicy = WebSocket.SENDDROP
+
+      self.poller = Poller()
+      self.serverfileno = self.serversocket.fileno()
+      self.poller.register(self.serverfileno, Poller.READ)
+
+      # wake up on the message queue if it has something to wait on, otherwise check it regularly
+      self.queuefileno = None
+      self.timeout = None
+      if self.message_queue is not None:
+         self.queuefileno = self.queueFileno(self.message_queue)
+         if self.queuefileno is not None and self.poller.canPollPipes():
+            self.poller.register(self.queuefileno, Poller.READ)
+         else:
+            self.queuefileno = None
+            self.timeout = 0.01
+
+   # file descriptor that becomes readable when the queue has messages, if there is one
+   def queueFileno(self, message_queue):
+      if hasattr(message_queue, 'fileno'):
+         return message_queue.fileno()
+      reader = getattr(message_queue, '_reader', None)   # multiprocessing.Queue pipe
+      if reader is not None:
+         return reader.fileno()
+      return None
+
    def decorateSocket(self, sock):
       return sock
 
@@ -542,73 +785,138 @@ class SimpleWebSocketServer(object):
    
          conn.close()
 
+      self.poller.close()
+
+   def removeConnection(self, fileno):
+      client = self.connections.pop(fileno)
+      self.poller.unregister(fileno)
+
+      try:
+         client.handleClose()
+      except:
+         pass
+
+      client.close()
+
+   def acceptConnection(self):
+      sock = None
+      address = None
+      try:
+         sock, address = self.serversocket.accept()
+         newsock = self.decorateSocket(sock)
+         newsock.setblocking(0)
+         fileno = newsock.fileno()
+         self.connections[fileno] = self.constructWebSocket(newsock, address)
+         self.poller.register(fileno, Poller.READ)
+
+      except Exception as n:
+
+         logging.debug(str(address) + ' ' + str(n))
+
+         if sock is not None:
+            sock.close()
+
+   # watch a connection for writability while it has queued frames
+   def waitForWrite(self, conn, waiting):
+      fileno = conn.client.fileno()
+      if fileno in self.connections:
+         self.poller.modify(fileno, (Poller.READ | Poller.WRITE) if waiting else Poller.READ)
+
+   # messages that slow clients may miss (see WebSocket.sendpolicy)
+   def isDroppable(self, message):
+      return False
+
+   # send a message to connections (all of them by default), encoding each
+   # distinct payload and frame once and writing the same buffer to every connection
+   def broadcast(self, message, connections=None, droppable=False):
+      if connections is None:
+         connections = self.connections.itervalues()
+
+      payloads = {}
+      frames = {}
+      failed = []
+      for conn in connections:
+         if conn.handshaked is False:
+            continue
+         try:
+            payloadkey = conn.payloadKey()
+            payload = payloads.get(payloadkey)
+            if payload is None:
+               payload = payloads[payloadkey] = conn.encodePayload(message)
+
+            framekey = conn.frameKey()
+            if framekey is None:
+               conn.sendPayload(payload, droppable)
+               continue
+
+            framekey = (payloadkey, framekey)
+            frame = frames.get(framekey)
+            if frame is None:
+               frame = frames[framekey] = conn.encodeFrame(payload)
+            conn.sendBuffer(frame, droppable)
+         except Exception as n:
+            logging.debug(str(conn.address) + ' ' + str(n))
+            failed.append(conn)
+
+      # clients that fell too far behind or broke
+      for conn in failed:
+         fileno = conn.client.fileno()
+         if fileno in self.connections:
+            self.removeConnection(fileno)
+
+   # send messages to all connected clients using multiprocessing.Queue
+   def sendQueued(self):
+      while not self.message_queue.empty():
+         message = self.message_queue.get()
+         self.broadcast(message, droppable=self.isDroppable(message))
 
    def serveforever(self):
       while True:
-         rList, wList, xList = select(self.listeners, [], self.listeners, 1)	
+         events = self.poller.poll(self.timeout)
 
-         for ready in rList:
-            if ready == self.serversocket:
-               try:
-                  sock, address = self.serversocket.accept()
-                  newsock = self.decorateSocket(sock)
-                  newsock.setblocking(0)
-                  fileno = newsock.fileno()
-                  self.listeners.append(fileno)
-                  self.connections[fileno] = self.constructWebSocket(newsock, address)
+         for fileno, event in events:
+            if fileno == self.serverfileno:
+               if event & Poller.ERROR:
+                  self.close()
+                  raise Exception("server socket failed")
+               self.acceptConnection()
 
-               except Exception as n:
+            elif fileno == self.queuefileno:
+               self.sendQueued()
 
-                  logging.debug(str(address) + ' ' + str(n))
-
-                  if sock is not None:
-                     sock.close()
             else:
-               client = self.connections[ready]
+               client = self.connections.get(fileno)
+               if client is None:
+                  continue
 
-               try:
-                  client.handleData()
+               if event & Poller.READ:
+                  try:
+                     client.handleData()
 
-               except Exception as n:
+                  except Exception as n:
 
-                  logging.debug(str(client.address) + ' ' + str(n))
+                     logging.debug(str(client.address) + ' ' + str(n))
 
-                  try:
-                     client.handleClose()
-                  except:
-                     pass
+                     self.removeConnection(fileno)
+                     continue
 
-                  client.close()
+               if event & Poller.WRITE:
+                  try:
+                     client.flush()
 
-                  del self.connections[ready]
-                  self.listeners.remove(ready)
-      
-         for failed in xList:
-            if failed == self.serversocket:
-               self.close()
-               raise Exception("server socket failed")
-            else:
-               client = self.connections[failed]
+                  except Exception as n:
 
-               try:
-                  client.handleClose()
-               except:
-                  pass
+                     logging.debug(str(client.address) + ' ' + str(n))
 
-               client.close()
+                     self.removeConnection(fileno)
+                     continue
 
-               del self.connections[failed]
-               self.listeners.remove(failed)
+               if event & Poller.ERROR:
+                  self.removeConnection(fileno)
 
-         # send messages to all connected clients using multiprocessing.Queue
-         if self.message_queue != None:
-            while not self.message_queue.empty():
-               message = str(self.message_queue.get())
-               for conn in self.connections.itervalues():
-                  try:
-                     conn.sendMessage(message)
-                  except:
-                     pass
+         # queues without a file descriptor are checked every time round
+         if self.message_queue != None and self.queuefileno is None:
+            self.sendQueued()
                
 
 class SimpleSSLWebSocketServer(SimpleWebSocketServer):
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# Per stroke analytics, computed once in the server for every STROKE_END instead
+# of in every client: peak force, time to peak, impulse and so on from the force
+# curve, and rolling aggregates over each erg's last strokes. The strokes in a
+# batch of messages are analysed together, in plain python, or with numpy for the
+# sums of batches of NUMPY_MIN_BATCH strokes or more. Both give the same results.
+
+# ==============================================================================
+# IMPORTS
+# ==============================================================================
+
+import collections
+import itertools
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    # the same metrics are computed in pure python
+
+# ==============================================================================
+# CONSTANTS
+# ==============================================================================
+
+# seconds between force plot samples (force is in pounds, as the erg reports it)
+SAMPLE_INTERVAL = 0.01
+
+# strokes the rolling aggregates are taken over
+ROLLING_WINDOW = 10
+
+# batches of this many strokes have their sums taken with numpy. real batches are a
+# few strokes, and python's own max and sum are already fast over a drive's samples
+NUMPY_MIN_BATCH = 64
+
+# metrics that are averaged over the window
+ROLLING_METRICS = ('peak_force', 'average_force', 'impulse', 'time_to_peak', 'peak_position')
+
+# ==============================================================================
+# STROKE METRICS
+# ==============================================================================
+
+# metrics of a drive from its force samples:
+#   peak_force, average_force, time_to_peak (seconds), peak_position (time to
+#   peak over drive time), drive_time (seconds), impulse (area under the curve,
+#   pound seconds), peak_ratio (average over peak force, how full the curve is)
+def make_metrics(samples, peak, peak_index, total, first, last):
+    if samples == 0:
+        return { 'samples': 0, 'peak_force': 0, 'average_force': 0.0, 'time_to_peak': 0.0, 'peak_position': 0.0,
+                 'drive_time': 0.0, 'impulse': 0.0, 'peak_ratio': 0.0 }
+
+    average = float(total) / samples
+    return {
+        'samples': samples,
+        'peak_force': int(peak),
+        'average_force': round(average, 2),
+        'time_to_peak': round(peak_index * SAMPLE_INTERVAL, 2),
+        'peak_position': round(float(peak_index) / samples, 3),
+        'drive_time': round(samples * SAMPLE_INTERVAL, 2),
+        'impulse': round((total - (first + last) / 2.0) * SAMPLE_INTERVAL, 3),   # trapezoidal
+        'peak_ratio': round(average / peak, 3) if peak else 0.0,
+    }
+
+# the metrics of several force curves at once. plain python is what normally runs,
+# numpy only takes big batches (a server catching up, or a great many ergs)
+def batch_metrics(forceplots):
+    if numpy is None or len(forceplots) < NUMPY_MIN_BATCH:
+        return [python_metrics(forceplot) for forceplot in forceplots]
+    return numpy_metrics(forceplots)
+
+# the integer sums of every curve in one vectorized pass, then make_metrics does
+# the arithmetic and rounding exactly as python_metrics does (numpy rounds half
+# to even, python 2 half away from zero)
+def numpy_metrics(forceplots):
+    # one row per curve, padded with zeros, filled from all the samples in one go
+    lengths = numpy.fromiter((len(forceplot) for forceplot in forceplots), numpy.int64, len(forceplots))
+    samples = numpy.fromiter(itertools.chain.from_iterable(forceplots), numpy.int64, int(lengths.sum()))
+    rows = numpy.arange(len(forceplots))
+    starts = numpy.cumsum(lengths) - lengths
+    curves = numpy.zeros((len(forceplots), max(1, int(lengths.max()))), numpy.int64)
+    curves[numpy.repeat(rows, lengths), numpy.arange(len(samples)) - numpy.repeat(starts, lengths)] = samples
+
+    columns = [
+        lengths.tolist(),
+        curves.max(axis=1).tolist(),
+        curves.argmax(axis=1).tolist(),
+        curves.sum(axis=1).tolist(),
+        curves[:, 0].tolist(),
+        curves[rows, numpy.maximum(lengths - 1, 0)].tolist(),
+    ]
+    return [make_metrics(*values) for values in zip(*columns)]
+
+def python_metrics(forceplot):
+    if not forceplot:
+        return make_metrics(0, 0, 0, 0, 0, 0)
+    peak = max(forceplot)
+    return make_metrics(len(forceplot), peak, forceplot.index(peak), sum(forceplot), forceplot[0], forceplot[-1])
+
+# mean of each rolling metric over a window of stroke metrics, and how consistent
+# the strokes were (coefficient of variation of the impulse, 0 is identical strokes).
+# windows are a few strokes, which python handles quicker than numpy
+def rolling_metrics(window):
+    rolling = { 'strokes': len(window) }
+    for name in ROLLING_METRICS:
+        rolling[name] = round(sum(metrics[name] for metrics in window) / float(len(window)), 3)
+
+    impulse_mean = sum(metrics['impulse'] for metrics in window) / float(len(window))
+    impulse_std = math.sqrt(sum((metrics['impulse'] - impulse_mean) ** 2 for metrics in window) / len(window))
+    rolling['impulse_cv'] = round(impulse_std / impulse_mean, 3) if impulse_mean else 0.0
+    return rolling
+
+# ==============================================================================
+# SERVER STAGE
+# ==============================================================================
+
+# adds an 'analytics' dict (the stroke's metrics, plus 'rolling' over the erg's
+# last window strokes) to the content of every STROKE_END passed through annotate()
+class StrokeAnalytics(object):
+
+    def __init__(self, window=ROLLING_WINDOW):
+        self.window = window
+        self.history = {}   # each erg's last strokes' metrics
+
+    # annotate the STROKE_ENDs in a batch of messages, in place
+    def annotate(self, messages):
+        strokes = []
+        for message in messages:
+            msg_type = message['type']
+            content = message['content']
+            if msg_type == "STROKE_END":
+                strokes.append(content)
+            elif msg_type == "WORKOUT_START" or (msg_type == "ERG_HEALTH" and 'error' in content):
+                # a new workout (or a restarted monitor) starts the rolling window over
+                self.flush(strokes)
+                strokes = []
+                self.history.pop(content.get('erg_id'), None)
+        self.flush(strokes)
+
+    def flush(self, strokes):
+        if not strokes:
+            return
+
+        for content, metrics in zip(strokes, batch_metrics([content['forceplot'] for content in strokes])):
+            history = self.history.get(content['erg_id'])
+            if history is None:
+                history = self.history[content['erg_id']] = collections.deque(maxlen=self.window)
+            history.append(metrics)
+
+            content['analytics'] = dict(metrics, rolling=rolling_metrics(history))
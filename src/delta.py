@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Delta encoded monitor readings. Clients that connect with ?monitor=delta get
+# each message's 'monitor' as only the fields that changed since the last
+# monitor they were sent for that erg, with a full keyframe every so often.
+# Most of the fields (calories, heart rate, status, often spm) barely change
+# from one message to the next.
+
+# ==============================================================================
+# IMPORTS
+# ==============================================================================
+
+import collections
+
+# ==============================================================================
+# CONSTANTS
+# ==============================================================================
+
+# every erg's monitor is sent in full to all delta clients once every this many updates
+KEYFRAME_INTERVAL = 10
+
+# ==============================================================================
+# MONITOR DELTAS
+# ==============================================================================
+
+# the last few monitor readings of every erg, by version. versions count up
+# across all ergs and are never reused, so a client's last version is either
+# still here to diff against or it gets a keyframe
+class MonitorDeltas(object):
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.version = 0
+        self.ergs = {}      # erg_id: OrderedDict of version: monitor
+        self.updates = {}   # erg_id: monitor updates so far
+
+    # note a message's monitor, returning (version, keyframe) or None if it has no monitor
+    def update(self, message):
+        content = message['content']
+        if not isinstance(content, dict) or content.get('erg_id') is None:
+            return None
+        erg_id = str(content['erg_id'])
+
+        if message['type'] == "ERG_HEALTH" and 'error' in content:
+            self.ergs.pop(erg_id, None)
+            self.updates.pop(erg_id, None)
+            return None
+        if not isinstance(content.get('monitor'), dict):
+            return None
+
+        self.version += 1
+        history = self.ergs.get(erg_id)
+        if history is None:
+            history = self.ergs[erg_id] = collections.OrderedDict()
+        history[self.version] = content['monitor']
+        while len(history) > self.keyframe_interval:
+            history.popitem(last=False)
+
+        updates = self.updates.get(erg_id, 0)
+        self.updates[erg_id] = updates + 1
+        return self.version, updates % self.keyframe_interval == 0
+
+    # the message for clients that were last sent version base of the erg's monitor
+    # (None for a keyframe): 'monitor' has just the fields that changed, and 'keyframe'
+    # says whether it is complete
+    def encode(self, message, erg_id, base):
+        content = message['content']
+        monitor = content['monitor']
+        previous = self.ergs.get(erg_id, {}).get(base) if base is not None else None
+
+        if previous is None:
+            content = dict(content, keyframe=True)
+        else:
+            changed = dict((name, value) for name, value in monitor.items() if name not in previous or previous[name] != value)
+            content = dict(content, monitor=changed, keyframe=False)
+        return dict(message, content=content)
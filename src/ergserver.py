@@ -11,13 +11,24 @@
 import pyrow.pyrow as pyrow # handles connection to ergs
 import time     # for sleep
 import json     # for converting data into json strings
+import struct   # for packing binary messages
 import sys      # sys.exit
+import threading
+from fnmatch import fnmatchcase   # for message type patterns
+from urlparse import urlparse, parse_qs
 
 # server
 import signal
 from optparse import OptionParser
 from SimpleWebSocketServer.SimpleWebSocketServer import SimpleWebSocketServer, WebSocket
-from multiprocessing import Process, Queue
+from multiprocessing import Process
+from ringqueue import RingQueue
+from recorder import SessionRecorder
+from analytics import StrokeAnalytics, ROLLING_WINDOW
+from snapshot import SnapshotCache, SNAPSHOT_STROKES
+from delta import MonitorDeltas, KEYFRAME_INTERVAL
+from latency import LatencyTracker, LATENCY_WINDOW, LATENCY_INTERVAL
+import replay   # stand-in ergs
 
 # ==============================================================================
 # CLIENT CONNECTION CLASS
@@ -25,151 +36,712 @@ from multiprocessing import Process, Queue
 
 class ErgSocket(WebSocket):
 
+    # clients choose the compact binary format with ws://host:port/?format=binary
+    binary = False
+
+    # what the client subscribed to: erg serials and message type patterns (None for all)
+    ergs = None
+    types = None
+    # delta clients get monitors as the fields changed since the last one they were sent
+    delta = False
+
     # receive message from client
     def handleMessage(self):
         if self.data is None:
             self.data = ''
 
-        print("{}: got message: {}".format(self.address, self.data))
+        try:
+            message = json.loads(str(self.data))
+        except ValueError:
+            message = None
+
+        if isinstance(message, dict) and message.get('type') == "SUBSCRIBE":
+            self.subscribe(message.get('content') or {})
+        else:
+            print("{}: got message: {}".format(self.address, self.data))
+
+    # {"type": "SUBSCRIBE", "content": {"ergs": ["300123456"], "types": ["WORKOUT_*", "STROKE_END"]}}
+    # leaving out ergs or types (or null) subscribes to all of them
+    def subscribe(self, content):
+        ergs = content.get('ergs') if isinstance(content, dict) else None
+        types = content.get('types') if isinstance(content, dict) else None
+        if not isinstance(content, dict) or not all(value is None or isinstance(value, list) for value in (ergs, types)):
+            self.sendMessage({ 'type': "ERROR", 'content': "SUBSCRIBE content must have lists of 'ergs' and 'types'" })
+            return
+
+        previous = (self.ergs, self.types)
+        self.setSubscription(ergs, types)
+        self.sendMessage({ 'type': "SUBSCRIBED", 'content': { 'ergs': None if ergs is None else sorted(self.ergs),
+                                                              'types': None if types is None else list(self.types) } })
+        print("{}: subscribed to ergs {}, types {}".format(self.address, ergs or "all", types or "all"))
+
+        # catch up on the newly subscribed ergs, unless the subscription is the same as before
+        if (self.ergs, self.types) != previous:
+            self.sendSnapshot()
+
+    def setSubscription(self, ergs, types):
+        self.ergs = None if ergs is None else frozenset(str(erg_id) for erg_id in ergs)
+        self.types = None if types is None else tuple(str(pattern) for pattern in types)
+        self.server.topicsChanged()
+
+    # everything the server knows about the subscribed ergs, for clients that join mid workout
+    def sendSnapshot(self):
+        snapshots = self.server.snapshots
+        if snapshots is None or not self.isSubscribed(None, "SNAPSHOT"):
+            return
+        self.sendMessage({ 'type': "SNAPSHOT", 'content': snapshots.snapshot(self.ergs), 'time': time.time() })
+
+    # does the client want messages of msg_type about erg_id (None for messages that aren't about an erg)
+    def isSubscribed(self, erg_id, msg_type):
+        if self.ergs is not None and erg_id is not None and erg_id not in self.ergs:
+            return False
+        if self.types is not None and not any(fnmatchcase(msg_type, pattern) for pattern in self.types):
+            return False
+        return True
 
     # client connected
     def handleConnected(self):
-        print("{}: connected".format(self.address))
+        query = parse_qs(urlparse(self.request.path).query)
+        # hixie76 has no binary frames
+        self.binary = query.get('format', [''])[0] == 'binary' and self.hixie76 is False
+        # ?monitor=delta, binary STROKE_END is already compact so only for json
+        self.delta = query.get('monitor', [''])[0] == 'delta' and not self.binary
+        self.monitors = {}  # erg_id: version of the last monitor sent, for delta clients
+
+        # a subscription can be given up front too, e.g. ?ergs=300123456&types=WORKOUT_*,STROKE_END
+        ergs, types = [[item for value in query[key] for item in value.split(',') if item] if key in query else None
+                       for key in ('ergs', 'types')]
+        self.setSubscription(ergs, types)
+
+        print("{}: connected{}{}".format(self.address, " (binary)" if self.binary else "", " (delta)" if self.delta else ""))
+
+        self.sendSnapshot()
 
     # client disconnected
     def handleClose(self):
+        self.server.topicsChanged()
         print("{}: closed".format(self.address))
 
+    # json and binary clients get different payloads for the same message
+    def payloadKey(self):
+        return self.binary
+
+    # messages are queued as dicts and serialized once per broadcast (and format)
+    def encodePayload(self, message):
+        if self.binary:
+            payload = encode_binary(message)
+            if payload is not None:
+                return payload
+        return json.dumps(message)
+
+# ==============================================================================
+# SERVER CLASS
+# ==============================================================================
+
+class ErgServer(SimpleWebSocketServer):
+
+    recorder = None     # SessionRecorder when recording workouts
+    analytics = None    # StrokeAnalytics adding metrics to every STROKE_END
+    snapshots = None    # SnapshotCache sent to clients as they connect
+    deltas = None       # MonitorDeltas for clients that want monitors delta encoded
+    latency = None      # LatencyTracker of the messages' trace stamps
+    latency_interval = LATENCY_INTERVAL
+
+    def __init__(self, *args, **kwargs):
+        super(ErgServer, self).__init__(*args, **kwargs)
+        # subscribed connections for each topic (erg id, message type), worked out
+        # the first time a topic is sent and forgotten when any subscription changes
+        self.topics = {}
+        self.latency_time = pyrow.monotonic()
+
+    # record messages as they come in, whether or not any clients are connected.
+    # everything waiting is taken at once, so strokes that ended together are analysed together
+    def sendQueued(self):
+        messages = []
+        traces = []     # the trace stamps stay in the server
+        while not self.message_queue.empty():
+            message = self.message_queue.get()
+            trace = message.pop('trace', None)
+            if trace is not None:
+                trace.append(pyrow.monotonic())
+            messages.append(message)
+            traces.append(trace)
+
+        if self.analytics is not None:
+            self.analytics.annotate(messages)
+
+        for message, trace in zip(messages, traces):
+            if self.recorder is not None:
+                self.recorder.record(message)
+            if self.snapshots is not None:
+                self.snapshots.update(message)
+
+            update = self.deltas.update(message) if self.deltas is not None else None
+            if update is None:
+                self.broadcast(message, self.subscribers(message), droppable=self.isDroppable(message))
+            else:
+                self.broadcastMonitor(message, update)
+
+            if self.latency is not None and trace is not None:
+                trace.append(pyrow.monotonic())
+                self.latency.add(trace)
+
+        if self.latency is not None and self.latency_interval:
+            self.sendLatency()
+
+    # rolling percentiles of each stage's latency, every latency_interval seconds
+    def sendLatency(self):
+        now = pyrow.monotonic()
+        if now - self.latency_time < self.latency_interval:
+            return
+        self.latency_time = now
+
+        message = { 'type': "LATENCY", 'content': self.latency.report(), 'time': time.time() }
+        self.broadcast(message, self.subscribers(message))
+
+    # a message with a monitor goes whole to most clients, and to delta clients as what
+    # changed since the monitor each was last sent. delta clients sent the same monitor
+    # last (usually all of them) share one encoded delta
+    def broadcastMonitor(self, message, update):
+        version, keyframe = update
+        erg_id = str(message['content']['erg_id'])
+        droppable = self.isDroppable(message)
+
+        full = []
+        deltas = {}     # base version: connections
+        for conn in self.subscribers(message):
+            if not conn.delta:
+                full.append(conn)
+                continue
+            base = None if keyframe else conn.monitors.get(erg_id)
+            conn.monitors[erg_id] = version
+            deltas.setdefault(base, []).append(conn)
+
+        if full:
+            self.broadcast(message, full, droppable=droppable)
+        for base, connections in deltas.iteritems():
+            self.broadcast(self.deltas.encode(message, erg_id, base), connections, droppable=droppable)
+
+    # the connections subscribed to a message's erg and type
+    def subscribers(self, message):
+        content = message['content']
+        erg_id = content.get('erg_id') if isinstance(content, dict) else None
+        topic = (None if erg_id is None else str(erg_id), message['type'])
+
+        connections = self.topics.get(topic)
+        if connections is None:
+            connections = self.topics[topic] = [conn for conn in self.connections.itervalues()
+                                                if conn.handshaked and conn.isSubscribed(*topic)]
+        return connections
+
+    # a client connected, left or changed its subscription
+    def topicsChanged(self):
+        self.topics.clear()
+
+    # force samples are superseded by the next one, so lagging clients can skip them
+    def isDroppable(self, message):
+        return message['type'] in DROPPABLE_TYPES
+
+
+
+# ==============================================================================
+# POLLING STATES
+# ==============================================================================
+
+STATE_IDLE = 'idle'                 # no workout set (or the last one finished)
+STATE_WAITING = 'waiting'           # workout set, waiting for it to begin
+STATE_DRIVE = 'drive'               # pulling, force plot is polled at full rate
+STATE_RECOVERY = 'recovery'         # between strokes, waiting for the next drive
+STATE_WORKOUT_END = 'workout_end'   # workout finished, send the summary
+
+# minimum seconds between polls in each state (0 = as fast as the erg's frame gap allows)
+POLL_INTERVALS = {
+    STATE_IDLE: 1.0,
+    STATE_WAITING: 0.1,
+    STATE_DRIVE: 0.0,
+    STATE_RECOVERY: 0.1,
+    STATE_WORKOUT_END: 0.0,
+}
+
+# messages that can be skipped when the server or a client falls behind (everything else is always delivered)
+DROPPABLE_TYPES = ("STROKE_FORCE",)
+
+# --send-policy: what happens to a client whose send buffer goes over --send-buffer
+SEND_POLICIES = { 'drop': WebSocket.SENDDROP, 'disconnect': WebSocket.SENDDISCONNECT }
+
+# seconds between ERG_HEALTH messages from each monitor
+HEALTH_INTERVAL = 5.0
+
+# device supervision: seconds between usb rescans, and restart backoff for failed monitors
+RESCAN_INTERVAL = 2.0
+RESTART_BACKOFF_MIN = 1.0
+RESTART_BACKOFF_MAX = 60.0
+RESTART_BACKOFF_RESET = 60.0    # a monitor that ran this long resets its backoff
+MONITOR_STOP_TIMEOUT = 2.0      # seconds to wait for a monitor to stop (a usb read can take a second to time out)
 
+# ==============================================================================
+# BINARY MESSAGES
+# ==============================================================================
+
+# binary clients get STROKE_FORCE and STROKE_END as little-endian binary frames
+# (everything else is still json). each starts with a 20 byte header:
+#   uint8 type, uint8 reserved, uint16 sample count, uint32 erg id (serial),
+#   uint32 stroke id, float64 time (work time in seconds)
+# STROKE_END then has a 16 byte monitor block:
+#   float32 distance, float32 pace, uint16 spm, uint16 power, uint16 calories,
+#   uint8 heartrate, uint8 status
+# followed by the force samples as uint16s
+BINARY_TYPES = { "STROKE_FORCE": 1, "STROKE_END": 2 }
+BINARY_HEADER = struct.Struct('<BBHIId')
+BINARY_MONITOR = struct.Struct('<ffHHHBB')
+
+# pack a queued message for binary clients, None if it has no binary form
+def encode_binary(message):
+    msg_type = BINARY_TYPES.get(message['type'])
+    if msg_type is None:
+        return None
+
+    content = message['content']
+    forceplot = content['forceplot']
+    erg_id = content['erg_id']
+    erg_id = int(erg_id) if str(erg_id).isdigit() else 0
+
+    if msg_type == BINARY_TYPES["STROKE_END"]:
+        monitor = content['monitor']
+        data = bytearray(BINARY_HEADER.pack(msg_type, 0, len(forceplot), erg_id, content['stroke_id'], monitor['time']))
+        data += BINARY_MONITOR.pack(monitor['distance'], monitor['pace'], monitor['spm'], monitor['power'],
+                                    monitor['calories'], monitor['heartrate'], monitor['status'])
+    else:
+        data = bytearray(BINARY_HEADER.pack(msg_type, 0, len(forceplot), erg_id, content['stroke_id'], content['time']))
+
+    data += struct.pack('<%dH' % len(forceplot), *forceplot)
+    return data
 
 # ==============================================================================
 # CORE FUNCTIONS
 # ==============================================================================
 
-# take an object, create a formatted message and queue it
-def queue_message(message_queue, msg_content, msg_type="TXT", log=True):
-    message = { 'type': msg_type, 'content': msg_content, 'time': time.clock() }
-    message_json = json.dumps(message)
+# take an object, create a formatted message and queue it (the server converts it to json).
+# trace is the erg's trace from the read the message came from (see pyrow.send), the
+# server takes the stamps off and adds them up (see latency.py)
+def queue_message(message_queue, msg_content, msg_type="TXT", log=True, trace=None):
+    message = { 'type': msg_type, 'content': msg_content, 'time': time.time(),
+                'trace': (list(trace) if trace is not None else [None, None, None]) + [pyrow.monotonic()] }
 
-    message_queue.put(message_json)
+    message_queue.put(message, msg_type in DROPPABLE_TYPES)
 
     if log == True:
         if msg_type == "TXT":
             print("[SEND] {}".format(str(msg_content)))
         else:
-            print("[SEND] {} ({} bytes)".format(msg_type, len(message_json)))
+            print("[SEND] {}".format(msg_type))
 
 # monitor a connected erg and send messages to clients connected to the server
-def monitor_erg(message_queue, erg):
+# runs as a state machine, where each state has its own poll set and cadence.
+# message_queue is this monitor's MessageRing, which never blocks. a monitor
+# running as a thread stops when stopped is set
+def monitor_erg(message_queue, erg, poll_intervals=POLL_INTERVALS, stopped=None):
+    erg_id = None
+    state = None
+    if stopped is None:
+        stopped = threading.Event()
     try:
-        sleep_time_ms = 5
-        sleep_time = float(sleep_time_ms) / 1000.0
-
-        erg_info = pyrow.pyrow.getErg(erg)
-        erg_status = pyrow.pyrow.getStatus(erg)
+        erg_info = erg.getErg()
         erg_id = erg_info['serial']
 
         message = "Concept 2 erg connected (model {}, serial: {})".format(erg_info['model'], erg_id)
         queue_message(message_queue, message);
+        queue_message(message_queue, { 'erg_id': erg_id, 'erg': erg_info }, msg_type="ERG_INFO", log=False, trace=erg.trace)
+
+        state = STATE_IDLE
+        last_poll = pyrow.monotonic()
+        stroke_id = 0
+        force = []
 
-        # wait for workout to begin, then send stroke data
-        queue_message(message_queue, "Waiting for workout to begin...")
+        # health reporting
+        polls = 0
+        health_time = last_poll
 
         # keep monitoring indefinitely
-        while True:
-            workout = erg.getWorkout()
-            while workout['state'] == 0:
-                time.sleep(sleep_time)
+        while not stopped.is_set():
+            # until the next poll is due (the state's poll interval, and the erg's frame gap so
+            # send() doesn't sleep through it) pass on any events still waiting for room in the ring
+            due = max(last_poll + poll_intervals[state], pyrow.monotonic() + erg.getSendDelay())
+            message_queue.flush(max(0., due - pyrow.monotonic()))
+            delay = due - pyrow.monotonic()
+            if delay > 0 and stopped.wait(delay):
+                break
+            last_poll = pyrow.monotonic()
+            polls += 1
+
+            # report how this monitor is doing, so clients can see which ergs are live
+            if last_poll - health_time >= HEALTH_INTERVAL:
+                poll_rate = polls / (last_poll - health_time)
+                queue_message(message_queue, { 'erg_id': erg_id, 'state': state, 'poll_rate': round(poll_rate, 1), 'strokes': stroke_id }, msg_type="ERG_HEALTH", log=False)
+                polls = 0
+                health_time = last_poll
+
+            # check for a workout (getWorkout)
+            if state == STATE_IDLE or state == STATE_WAITING:
                 workout = erg.getWorkout()
-
-            # send workout start message
-            monitor = erg.getMonitor()
-            queue_message(message_queue, { 'erg_id' : erg_id, 'monitor' : monitor, 'workout' : workout }, msg_type="WORKOUT_START")
-
-            # record workout
-            stroke_id = 0
-            forceplot = erg.getForcePlot()
-            while workout['state'] == 1:
-                # record force data during the drive
-                force = forceplot['forceplot']  # start of pull (when strokestate first changed to 2)
-                monitor = erg.getMonitor()
-
-                # stroke start message
-                queue_message(message_queue, { 'erg_id': erg_id, 'stroke_id': stroke_id, 'monitor': monitor }, msg_type="STROKE_START", log=False)
-                queue_message(message_queue, { 'erg_id': erg_id, 'stroke_id': stroke_id, 'time': monitor['time'], 'force': forceplot['forceplot'] }, msg_type="STROKE_FORCE", log=False)
-                
-                # loop during drive (and make sure we get the end of the stroke)
-                while True:
+                if workout['state'] == 1:
+                    # send workout start message
                     monitor = erg.getMonitor()
-                    forceplot = erg.getForcePlot()
-                    force.extend(forceplot['forceplot'])
-                    queue_message(message_queue, { 'erg_id': erg_id, 'stroke_id': stroke_id, 'time': monitor['time'], 'forceplot': forceplot['forceplot'] }, msg_type="STROKE_FORCE", log=False)
-                    if forceplot['strokestate'] != 2:
-                        break
+                    queue_message(message_queue, { 'erg_id' : erg_id, 'monitor' : monitor, 'workout' : workout }, msg_type="WORKOUT_START", trace=erg.trace)
+                    stroke_id = 0
+                    state = STATE_RECOVERY
+                elif workout['state'] == 0:
+                    if state == STATE_IDLE:
+                        queue_message(message_queue, "Waiting for workout to begin...")
+                    state = STATE_WAITING
+                else:
+                    state = STATE_IDLE
+
+            # wait for next stroke (start of pull is when strokestate first changes to 2) (getStroke)
+            elif state == STATE_RECOVERY:
+                stroke = erg.getStroke()
+                stroke_trace = erg.trace
+                if stroke['state'] != 1:
+                    state = STATE_WORKOUT_END
+                elif stroke['strokestate'] == 2:
+                    # stroke start message
+                    force = list(stroke['forceplot'])
+                    monitor = erg.getMonitor()
+                    queue_message(message_queue, { 'erg_id': erg_id, 'stroke_id': stroke_id, 'monitor': monitor }, msg_type="STROKE_START", log=False, trace=erg.trace)
+                    queue_message(message_queue, { 'erg_id': erg_id, 'stroke_id': stroke_id, 'time': stroke['time'], 'forceplot': stroke['forceplot'] }, msg_type="STROKE_FORCE", log=False, trace=stroke_trace)
+                    state = STATE_DRIVE
 
-                monitor = erg.getMonitor()      # get monitor data for end of stroke
-                queue_message(message_queue, { 'erg_id': erg_id, 'stroke_id': stroke_id, 'monitor': monitor, 'forceplot': force }, msg_type="STROKE_END", log=False)
+            # record force data during the drive, one frame per sample (getStroke)
+            elif state == STATE_DRIVE:
+                stroke = erg.getStroke()
+                force.extend(stroke['forceplot'])
+                queue_message(message_queue, { 'erg_id': erg_id, 'stroke_id': stroke_id, 'time': stroke['time'], 'forceplot': stroke['forceplot'] }, msg_type="STROKE_FORCE", log=False, trace=erg.trace)
 
-                print("[{}] time: {}, distance: {}, pace: {}".format(stroke_id, monitor['time'], monitor['distance'], monitor['pace']))
+                # make sure we get the end of the stroke
+                if stroke['strokestate'] != 2 or stroke['state'] != 1:
+                    monitor = erg.getMonitor()      # get monitor data for end of stroke
+                    queue_message(message_queue, { 'erg_id': erg_id, 'stroke_id': stroke_id, 'monitor': monitor, 'forceplot': force }, msg_type="STROKE_END", log=False, trace=erg.trace)
 
-                # wait for next stroke
-                while forceplot['strokestate'] != 2 and workout['state'] == 1:
-                    forceplot = erg.getForcePlot()
-                    workout = erg.getWorkout()
+                    print("[{}] time: {}, distance: {}, pace: {}".format(stroke_id, monitor['time'], monitor['distance'], monitor['pace']))
 
-                stroke_id += 1
+                    stroke_id += 1
+                    state = STATE_RECOVERY if stroke['state'] == 1 else STATE_WORKOUT_END
 
-            workout = erg.getWorkout()
-            monitor = erg.getMonitor()
-            queue_message(message_queue, { 'erg_id': erg_id, 'monitor': monitor, 'workout': workout }, msg_type="WORKOUT_END")
+            # send workout end message, then go back to checking for a workout
+            elif state == STATE_WORKOUT_END:
+                workout = erg.getWorkout()
+                monitor = erg.getMonitor()
+                queue_message(message_queue, { 'erg_id': erg_id, 'monitor': monitor, 'workout': workout }, msg_type="WORKOUT_END", trace=erg.trace)
+                state = STATE_IDLE
 
     except Exception as e:
         print(e)
-        sys.exit(0)
+        try:
+            queue_message(message_queue, { 'erg_id': erg_id, 'state': state, 'error': str(e) }, msg_type="ERG_HEALTH")
+            message_queue.flush(1.0)
+        except:
+            pass
+
+
+# ==============================================================================
+# DEVICE SUPERVISOR
+# ==============================================================================
+
+# runs a monitor in the server process (single process mode), so messages go
+# straight to the server. behaves like a monitor process to the supervisor
+class MonitorThread(threading.Thread):
+
+    def __init__(self, message_queue, erg, poll_intervals):
+        super(MonitorThread, self).__init__()
+        self.message_queue = message_queue
+        self.erg = erg
+        self.poll_intervals = poll_intervals
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.finished = False
+        self.closing = False    # close the erg once stopped
+
+    def run(self):
+        try:
+            monitor_erg(self.message_queue, self.erg, self.poll_intervals, self.stopped)
+        finally:
+            with self.lock:
+                self.finished = True
+                closing = self.closing
+            if closing:
+                self.closeErg()
+
+    # stops after the current poll. with close the erg is closed too, by the thread once
+    # it is out of its usb call (or straight away if it has already stopped)
+    def terminate(self, close=False):
+        self.stopped.set()
+        if close:
+            with self.lock:
+                self.closing = not self.finished
+                if self.closing:
+                    return
+            self.closeErg()
+
+    def closeErg(self):
+        try:
+            self.erg.close()
+        except:
+            pass
+
+# attaches a monitor process to every connected erg, rescanning usb periodically
+# so ergs can be plugged in later and failed monitors are restarted with backoff
+class ErgSupervisor(threading.Thread):
+
+    def __init__(self, message_queue, poll_intervals, rescan_interval=RESCAN_INTERVAL, threads=False, find=None, connect=None):
+        super(ErgSupervisor, self).__init__()
+        self.daemon = True
+        self.message_queue = message_queue
+        self.poll_intervals = poll_intervals
+        self.rescan_interval = rescan_interval
+        self.threads = threads  # monitor with threads in this process instead of processes
+
+        # how to list the connected ergs and connect to one (usb by default)
+        self.find = find or pyrow.find
+        self.connect = connect or pyrow.pyrow
+
+        # everything is keyed by usb port (bus, address), which changes when an erg is replugged
+        self.ergs = {}      # claimed pyrow connections, reused when a monitor is restarted
+        self.serials = {}
+        self.monitors = {}  # monitor processes (or threads)
+        self.rings = {}     # each monitor's MessageRing, feeding the server's RingQueue
+        self.started = {}   # when each monitor was started
+        self.backoff = {}   # (failures, earliest restart time)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.scan()
+            except Exception as e:
+                print("[SUPERVISOR] scan failed: {}".format(e))
+            self.stopped.wait(self.rescan_interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join(self.rescan_interval + 5.0)   # let a scan in progress finish before stopping its monitors
+        for prc_monitor in self.monitors.values():
+            try:
+                prc_monitor.terminate()
+            except:
+                pass
+
+    def scan(self):
+        devices = dict(((device.bus, device.address), device) for device in self.find())
+        now = pyrow.monotonic()
+
+        # forget ergs that have been unplugged
+        for port in list(self.ergs.keys()) + list(self.monitors.keys()):
+            if port not in devices:
+                self.detach(port)
+
+        for port, device in devices.items():
+            prc_monitor = self.monitors.get(port)
+            if prc_monitor is not None and prc_monitor.is_alive():
+                continue
+
+            failures, restart_time = self.backoff.get(port, (0, 0))
+            if prc_monitor is not None:
+                # monitor died, back off unless it had been running for a while
+                prc_monitor.join(0)
+                del self.monitors[port]
+                self.message_queue.release(self.rings.pop(port))
+                if now - self.started[port] >= RESTART_BACKOFF_RESET:
+                    failures = 0
+                failures += 1
+                restart_time = now + min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_MIN * 2 ** (failures - 1))
+                self.backoff[port] = (failures, restart_time)
+                print("[SUPERVISOR] monitor for erg {} stopped, restarting in {:.1f}s".format(self.serials.get(port), restart_time - now))
+
+            if now < restart_time:
+                continue
+
+            try:
+                self.attach(port, device)
+                self.backoff[port] = (failures, 0)
+            except Exception as e:
+                # the connection may be bad, so claim the interface again next time
+                self.ergs.pop(port, None)
+                failures += 1
+                self.backoff[port] = (failures, now + min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_MIN * 2 ** (failures - 1)))
+                print("[SUPERVISOR] could not connect to erg on usb {}: {}".format(port, e))
+
+    # connect to an erg (reusing an already claimed interface) and monitor it using a new process (or thread)
+    def attach(self, port, device):
+        erg = self.ergs.get(port)
+        if erg is None:
+            erg = self.connect(device)
+            self.ergs[port] = erg
+        erg_id = erg.getErg()['serial']
+
+        # the ring is shared memory, so it has to exist before the process starts
+        ring = self.message_queue.ring(local=self.threads)
+        if self.threads:
+            prc_monitor = MonitorThread(ring, erg, self.poll_intervals)
+        else:
+            prc_monitor = Process(target=monitor_erg, args=(ring, erg, self.poll_intervals))
+        prc_monitor.daemon = True
+        try:
+            prc_monitor.start()
+        except:
+            self.message_queue.release(ring)
+            raise
+
+        self.serials[port] = erg_id
+        self.monitors[port] = prc_monitor
+        self.rings[port] = ring
+        self.started[port] = pyrow.monotonic()
+        print("[SUPERVISOR] monitoring erg {}".format(erg_id))
+
+    def detach(self, port):
+        prc_monitor = self.monitors.pop(port, None)
+        erg = self.ergs.pop(port, None)
+        if prc_monitor is not None:
+            if self.threads:
+                # the thread shares our erg and may be in the middle of a usb call with it
+                prc_monitor.terminate(close=True)
+                erg = None
+            else:
+                prc_monitor.terminate()
+            prc_monitor.join(MONITOR_STOP_TIMEOUT)
+            if prc_monitor.is_alive():
+                print("[SUPERVISOR] monitor for erg {} is still stopping".format(self.serials.get(port)))
+            self.message_queue.release(self.rings.pop(port))
+
+        if erg is not None:
+            try:
+                erg.close()
+            except:
+                pass
+
+        self.backoff.pop(port, None)
+        erg_id = self.serials.pop(port, None)
+        if erg_id is not None:
+            queue_message(self.message_queue, "Concept 2 erg disconnected (serial: {})".format(erg_id))
+            queue_message(self.message_queue, { 'erg_id': erg_id, 'state': None, 'error': "disconnected" }, msg_type="ERG_HEALTH", log=False)
+
+# parse per state poll intervals from a string like 'idle=1.0,recovery=0.1'
+def parse_poll_intervals(option):
+    poll_intervals = dict(POLL_INTERVALS)
+    if option:
+        for item in option.split(','):
+            state, interval = item.split('=')
+            state = state.strip()
+            if state not in POLL_INTERVALS:
+                raise ValueError("unknown poll state '{}'".format(state))
+            poll_intervals[state] = float(interval)
+    return poll_intervals
 
 def main():
     # handle command line options
     parser = OptionParser(usage="usage: %prog [options]", version="%prog 1.0")
     parser.add_option("--host", default='', type='string', action="store", dest="host", help="hostname (localhost)")
     parser.add_option("--port", default=8000, type='int', action="store", dest="port", help="port (8000)")
+    parser.add_option("--poll", default='', type='string', action="store", dest="poll", help="seconds between polls per state, e.g. 'idle=1.0,waiting=0.1,recovery=0.1'")
+    parser.add_option("--threads", default=False, action="store_true", dest="threads", help="monitor ergs with threads in the server process instead of separate processes")
+    parser.add_option("--record", default='', type='string', action="store", dest="record", help="record every workout to a log per erg and session in this directory")
+    parser.add_option("--replay", default=[], type='string', action="append", dest="replay", help="replay a recorded session log (or 'synthetic' for a generated one) as an erg instead of using usb, can be given more than once")
+    parser.add_option("--speed", default=1.0, type='float', action="store", dest="speed", help="replay speed, 1 for real time, 0 for as fast as the ergs are polled (1)")
+    parser.add_option("--loop", default=False, action="store_true", dest="loop", help="start replays over when they finish")
+    parser.add_option("--analytics", default=ROLLING_WINDOW, type='int', action="store", dest="analytics", help="strokes the rolling stroke analytics are taken over, 0 to turn analytics off ({})".format(ROLLING_WINDOW))
+    parser.add_option("--snapshot-strokes", default=SNAPSHOT_STROKES, type='int', action="store", dest="snapshot_strokes", help="complete strokes per erg sent to clients that connect mid workout ({})".format(SNAPSHOT_STROKES))
+    parser.add_option("--keyframe-interval", default=KEYFRAME_INTERVAL, type='int', action="store", dest="keyframe_interval", help="monitor updates per erg between full keyframes for ?monitor=delta clients ({})".format(KEYFRAME_INTERVAL))
+    parser.add_option("--latency-interval", default=LATENCY_INTERVAL, type='float', action="store", dest="latency_interval", help="seconds between LATENCY messages with the per stage latency percentiles, 0 for none ({})".format(LATENCY_INTERVAL))
+    parser.add_option("--latency-window", default=LATENCY_WINDOW, type='int', action="store", dest="latency_window", help="latest messages the latency percentiles are taken over ({})".format(LATENCY_WINDOW))
+    parser.add_option("--deflate", default=0, type='int', action="store", dest="deflate", help="compress messages to clients that support it, 1 (fastest) to 9 (smallest) (0 = off)")
+    parser.add_option("--deflate-shared", default=False, action="store_true", dest="deflate_shared", help="compress each message once for all clients instead of per client (less cpu, larger frames)")
+    parser.add_option("--send-buffer", default=256, type='int', action="store", dest="send_buffer", help="kilobytes a slow client can fall behind by before --send-policy applies to it (256)")
+    parser.add_option("--send-policy", default="drop", type='choice', choices=list(SEND_POLICIES), action="store", dest="send_policy", help="what happens to a client over --send-buffer: 'drop' skips force samples for it (it is disconnected at 4x), 'disconnect' disconnects it (drop)")
     (options, args) = parser.parse_args()
-    
+    if options.deflate < 0 or options.deflate > 9:
+        parser.error("--deflate must be between 0 and 9")
+    if options.send_buffer < 1:
+        parser.error("--send-buffer must be at least 1")
+    if options.speed < 0:
+        parser.error("--speed can't be negative")
+    if options.analytics < 0:
+        parser.error("--analytics can't be negative")
+    if options.snapshot_strokes < 0:
+        parser.error("--snapshot-strokes can't be negative")
+    if options.keyframe_interval < 1:
+        parser.error("--keyframe-interval must be at least 1")
+    if options.latency_window < 1:
+        parser.error("--latency-window must be at least 1")
+    try:
+        # as fast as possible means not waiting between polls while rowing
+        poll = options.poll
+        if options.replay and options.speed == 0:
+            poll = ','.join(['waiting=0,recovery=0'] + ([poll] if poll else []))
+        poll_intervals = parse_poll_intervals(poll)
+    except ValueError as e:
+        parser.error(str(e))
+
+    find = connect = None
+    if options.replay:
+        try:
+            replay_ergs = replay.find(options.replay, options.speed, options.loop)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+        find = lambda: replay_ergs
+        connect = lambda device: device.connect()
+
     print("Welcome to ErgServer!")
 
-    # initialize connection to erg
-    connected_ergs = pyrow.find()
+    # initialize connection to ergs
+    connected_ergs = (find or pyrow.find)()
     if len(connected_ergs) == 0:
-        print("No ergs found.")
+        print("No ergs found yet. Starting ErgServer anyway, ergs will be picked up when connected.")
     else:
         print("{} erg(s) found. Starting ErgServer.".format(len(connected_ergs)))
-        print("(NOTE: This will run forever. Press ctrl+c to quit)")
-
-        try:
-            message_queue = Queue(20)
-
-            # connect to erg and monitor it using a new process
-            erg = pyrow.pyrow(connected_ergs[0])
-            prc_monitor = Process(target=monitor_erg, args=(message_queue, erg))
-            prc_monitor.start()
-
-            # start the websocket server to accept client connections
-            erg_server = SimpleWebSocketServer(options.host, options.port, ErgSocket, message_queue)
-
-            def close_sig_handler(signal, frame):
-                erg_server.close()
-                sys.exit(0)
+    print("(NOTE: This will run forever. Press ctrl+c to quit)")
 
-            signal.signal(signal.SIGINT, close_sig_handler)
-            erg_server.serveforever()
-
-        except:
-            pass
-
-    print("Closing ErgServer. See you next time!")
+    supervisor = None
+    recorder = None
     try:
-        prc_monitor.terminate()
+        message_queue = RingQueue()
+
+        # monitor every erg in its own process, each writing into its own ring in shared memory
+        # (or with --threads, in a thread of this process handing messages straight to the server)
+        supervisor = ErgSupervisor(message_queue, poll_intervals, threads=options.threads, find=find, connect=connect)
+        supervisor.start()
+
+        # start the websocket server to accept client connections
+        erg_server = ErgServer(options.host, options.port, ErgSocket, message_queue)
+        erg_server.deflatelevel = options.deflate
+        erg_server.deflatecontexttakeover = not options.deflate_shared
+        erg_server.maxsendbuffer = options.send_buffer * 1024
+        erg_server.sendpolicy = SEND_POLICIES[options.send_policy]
+        if options.analytics:
+            erg_server.analytics = StrokeAnalytics(options.analytics)
+        erg_server.snapshots = SnapshotCache(options.snapshot_strokes)
+        erg_server.deltas = MonitorDeltas(options.keyframe_interval)
+        erg_server.latency = LatencyTracker(options.latency_window)
+        erg_server.latency_interval = options.latency_interval
+
+        if options.record:
+            recorder = SessionRecorder(options.record)
+            recorder.start()
+            erg_server.recorder = recorder
+
+        def close_sig_handler(signal, frame):
+            erg_server.close()
+            sys.exit(0)
+
+        signal.signal(signal.SIGINT, close_sig_handler)
+        erg_server.serveforever()
+
     except:
         pass
+
+    print("Closing ErgServer. See you next time!")
+    if supervisor is not None:
+        supervisor.stop()
+    if recorder is not None:
+        recorder.stop()
     sys.exit(0)
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Where the time goes between the erg and the clients. Every message carries
+# monotonic stamps (pyrow.monotonic, which all processes share) from the erg
+# read it came from to the server handing it to the sockets:
+#   usb write, usb read, decode (see pyrow.send), queue put (queue_message),
+#   queue get and socket send (ErgServer.sendQueued)
+# and the server keeps rolling percentiles of the time spent in each stage,
+# sent to clients as LATENCY messages.
+
+# ==============================================================================
+# IMPORTS
+# ==============================================================================
+
+import collections
+
+# ==============================================================================
+# CONSTANTS
+# ==============================================================================
+
+# the stages, each from the stamp before it:
+#   usb: frame written to the erg until its response was read
+#   decode: response read until it was decoded
+#   put: decoded until the message was queued (building it, and any other reads it needed)
+#   queue: queued until the server took it (the ring, and the server getting round to it)
+#   send: taken until it was written to the sockets (analytics, encoding, fan-out)
+#   total: the first stamp there is until send
+STAGES = ('usb', 'decode', 'put', 'queue', 'send', 'total')
+
+# the latest samples of each stage the percentiles are taken over
+LATENCY_WINDOW = 1000
+
+# seconds between LATENCY messages (0 for none)
+LATENCY_INTERVAL = 10.0
+
+# ==============================================================================
+# PERCENTILES
+# ==============================================================================
+
+# nearest rank percentile of sorted values
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+# ==============================================================================
+# LATENCY TRACKER
+# ==============================================================================
+
+class LatencyTracker(object):
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.samples = dict((stage, collections.deque(maxlen=window)) for stage in STAGES)
+        self.counts = dict.fromkeys(STAGES, 0)  # samples ever taken
+
+    # a finished message's trace: [usb write, usb read, decode, queue put, queue get,
+    # socket send], None where the message wasn't stamped (messages that don't come
+    # from an erg read have no usb stamps)
+    def add(self, trace):
+        for stage, start, end in zip(STAGES, trace, trace[1:]):
+            if start is not None and end is not None:
+                self.sample(stage, end - start)
+
+        start = next((stamp for stamp in trace if stamp is not None), None)
+        if start is not None and trace[-1] is not None:
+            self.sample('total', trace[-1] - start)
+
+    def sample(self, stage, seconds):
+        self.samples[stage].append(seconds)
+        self.counts[stage] += 1
+
+    # LATENCY content: for each stage that has samples
+    #   { 'count' (ever), 'samples' (in the window), 'p50', 'p95', 'p99', 'max' }
+    # in milliseconds over the window
+    def report(self):
+        report = {}
+        for stage in STAGES:
+            values = sorted(self.samples[stage])
+            if not values:
+                continue
+            report[stage] = { 'count': self.counts[stage], 'samples': len(values),
+                              'p50': round(percentile(values, 50) * 1000, 3), 'p95': round(percentile(values, 95) * 1000, 3),
+                              'p99': round(percentile(values, 99) * 1000, 3), 'max': round(values[-1] * 1000, 3) }
+        return report
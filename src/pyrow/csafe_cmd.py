@@ -6,6 +6,9 @@
 
 #ToDo: change print statments to proper errors
 import csafe_dic
+import struct
+from functools import reduce
+from operator import xor
 
 def __int2bytes(numbytes, integer):
 	if not(0 <= integer <= 2 ** (8 * numbytes)): print("Integer is outside the allowable range")
@@ -116,7 +119,10 @@ def Write(arguments):
 			
 		j += 1
 	
-	#add checksum to end of message
+	#add checksum to end of message, stuffed like any other byte
+	if 0xF0 <= checksum <= 0xF3:
+		message.append(csafe_dic.Byte_Stuffing_Flag)
+		checksum = checksum & 0x3
 	message.append(checksum)
 	
 	#start & stop frames
@@ -147,46 +153,113 @@ def Write(arguments):
 		
 	return message
 
+#compiled frames, keyed by command signature
+__frames = {}
 
-def __checkMessage(message):
-	#prime variables
-	i = 0
-	checksum = 0
-	
-	#checksum and unstuff
-	while i < len(message):
-		#byte unstuffing
-		if message[i] == csafe_dic.Byte_Stuffing_Flag:
-			stuffvalue = message.pop(i + 1)
-			message[i] = 0xF0 | stuffvalue
-			
-		#calculate checksum
-		checksum = checksum ^ message[i]
+def Compile(arguments):
+	#Encodes a command list that never changes (polling queries) once, returning an immutable frame that can be
+	#passed straight to pyrow.send. Frames are cached so repeated calls with the same commands cost one lookup.
+	signature = tuple(arguments)
+	frame = __frames.get(signature)
+	if frame is None:
+		message = Write(list(signature))
+		if not message: #Write returns an empty list for frames it can't encode, only valid frames are cached
+			raise ValueError("Could not compile frame for {0}".format(list(signature)))
+		frame = bytes(bytearray(message))
+		__frames[signature] = frame
 		
-		i = i + 1
+	return frame
+
+
+#struct codes for little endian integers, by byte width
+__intcodes = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+def __compileFormat(fields):
+	#Returns a struct for a response field list, or None if a field width has no struct equivalent
+	fmt = '<'
+	for numbytes in fields:
+		if numbytes < 0:
+			fmt += '%ds' % -numbytes
+		elif numbytes in __intcodes:
+			fmt += __intcodes[numbytes]
+		else:
+			return None
 	
-	#checks checksum
-	if checksum != 0:
-		print("Checksum error")
-		return []
-		
-	#remove checksum from  end of message
-	del message[-1]
+	return struct.Struct(fmt)
+
+def __compilePlan(name, fields):
+	#Returns an immutable decode plan: (command name, fields, struct or None, data byte count, ASCII field indices)
+	fields = tuple(fields)
+	size = sum([abs(numbytes) for numbytes in fields])
+	asciifields = tuple([n for n, numbytes in enumerate(fields) if numbytes < 0])
+	fmt = __compileFormat(fields) if size else None #data-less responses decode to [0]
 	
-	return message
+	return (name, fields, fmt, size, asciifields)
+
+#Response schema registry, built once from csafe_dic and never modified so one decoder can be shared by
+#several ergs. Fixed layouts are keyed by command id, variable layouts by (command id, data byte count).
+__plans = {}
+for __cmdid, __msgprop in csafe_dic.resp.items():
+	if __cmdid not in csafe_dic.resp_variable:
+		__plans[__cmdid] = __compilePlan(__msgprop[0], __msgprop[1])
+__variableplans = {}
+
+def __getPlan(msgcmd, bytecount):
+	#Returns the decode plan for a command, compiling and caching variable length layouts on first use
+	plan = __plans.get(msgcmd)
+	if plan is not None:
+		return plan
+	
+	key = (msgcmd, bytecount)
+	plan = __variableplans.get(key)
+	if plan is None:
+		numbytes = csafe_dic.resp_variable[msgcmd]
+		if numbytes < 0:
+			fields = [-bytecount,]
+		else:
+			fields = [numbytes,] * (bytecount // numbytes)
+		plan = __variableplans.setdefault(key, __compilePlan(csafe_dic.resp[msgcmd][0], fields))
+	
+	return plan
+
+__wrapperid = csafe_dic.cmds['CSAFE_SETUSERCFG1_CMD'][0]
+__stuffflag = bytearray([csafe_dic.Byte_Stuffing_Flag])
+__stopflag = bytearray([csafe_dic.Stop_Frame_Flag])
+
+def __unstuff(message):
+	#Reverses byte stuffing in a single pass: every byte following a stuffing flag is restored to 0xF0 | value
+	if csafe_dic.Byte_Stuffing_Flag not in message:
+		return message
+	
+	chunks = message.split(__stuffflag)
+	for chunk in chunks[1:]:
+		if chunk: chunk[0] = 0xF0 | chunk[0]
+	
+	return bytearray().join(chunks)
+
+def __readFields(message, k, plan):
+	#Decodes a response field by field, for plans without a struct
+	result = []
+	for numbytes in plan[1]:
+		bytes = message[k:k + abs(numbytes)]
+		value = (__bytes2int(bytes) if numbytes >= 0 else __bytes2ascii(bytes))
+		result.append(value)
+		k = k + abs(numbytes)
+	
+	return result
 
 #for recieving!!
 def Read(transmission):
-	#prime variables
-	message = []
-	stopfound = False
+	#Decodes the array returned by erg.read without copying it byte by byte: the frame is located with C level
+	#searches, unstuffed in one pass and each command's data is unpacked with its precomputed struct
+	frame = bytearray(transmission)
 	
-	reportid = transmission[0]
-	startflag = transmission[1]
+	reportid = frame[0]
+	startflag = frame[1]
 	
 	if startflag == csafe_dic.Extended_Frame_Start_Flag:
-		destination = transmission[2]
-		source = transmission[3]
+		destination = frame[2]
+		source = frame[3]
 		j = 4
 	elif startflag == csafe_dic.Standard_Frame_Start_Flag:
 		j = 2
@@ -194,72 +267,59 @@ def Read(transmission):
 		print("No Start Flag found.")
 		return []
 	
-	while j < len(transmission):
-		if transmission[j] == csafe_dic.Stop_Frame_Flag:
-			stopfound = True
-			break
-		message.append(transmission[j])
-		j += 1
-		
-	if not(stopfound):
+	stop = frame.find(__stopflag, j)
+	if stop < 0:
 		print("No Stop Flag found.")
 		return []
 	
-	message = __checkMessage(message)
-	status = message.pop(0)
-		
+	message = __unstuff(frame[j:stop])
+	
+	#checks checksum (xor of the message including its checksum byte is 0)
+	if not message or reduce(xor, message, 0) != 0:
+		print("Checksum error")
+		return []
+	
 	#prime variables
+	status = message[0]
 	response = {'CSAFE_GETSTATUS_CMD' : [status,] }
-	k = 0
+	k = 1
+	end = len(message) - 1 #checksum is the last byte
 	wrapend = -1
 	wrapper = 0x0
 	
 	#loop through complete frames
-	while k < len(message):
-		result = []
-		
+	while k < end:
 		#get command name
 		msgcmd = message[k]
 		if(k <= wrapend): msgcmd = wrapper | msgcmd #check if still in wrapper
-		msgprop = csafe_dic.resp[msgcmd]
-		k = k + 1
 		
 		#get data byte count
-		bytecount = message[k]
-		k = k + 1 
+		bytecount = message[k + 1]
+		k = k + 2
 		
 		#if wrapper command then gets command in wrapper
-		if(msgprop[0] == 'CSAFE_SETUSERCFG1_CMD'):
-			wrapper = message[k - 2] << 8
-			wrapend = k  + bytecount - 1
+		if(msgcmd == __wrapperid):
+			wrapper = __wrapperid << 8
+			wrapend = k + bytecount - 1
 			if bytecount: #If wrapper length != 0
 				msgcmd = wrapper | message[k]
-				msgprop = csafe_dic.resp[msgcmd]
-				k = k + 1
-				bytecount = message[k]
-				k = k + 1 			
+				bytecount = message[k + 1]
+				k = k + 2
 		
-		#special case for capability code, response lengths differ based off capability code
-		if(msgprop[0] == 'CSAFE_GETCAPS_CMD'):
-			msgprop[1] = [1,] * bytecount
-			
-		#special case for get id, response length is variable
-		if(msgprop[0] == 'CSAFE_GETID_CMD'):
-			msgprop[1] = [(-bytecount),]
+		plan = __getPlan(msgcmd, bytecount)
 		
-		#checking that the recieved data byte is the expected length, sanity check
-		if abs(sum(msgprop[1])) != 0 and bytecount != abs(sum(msgprop[1])):
-			print("Warning: bytecount is an unexpected length")
-			
 		#extract values
-		for numbytes in msgprop[1]:
-			bytes = message[k:k + abs(numbytes)]
-			value = (__bytes2int(bytes) if numbytes >= 0 else __bytes2ascii(bytes))
-			result.append(value)
-			k = k + abs(numbytes)
+		if plan[2] is not None and bytecount == plan[3]:
+			result = list(plan[2].unpack_from(message, k))
+			for n in plan[4]:
+				result[n] = __bytes2ascii(bytearray(result[n]))
+		else:
+			#checking that the recieved data byte is the expected length, sanity check
+			if plan[3] != 0 and bytecount != plan[3]:
+				print("Warning: bytecount is an unexpected length")
+			result = __readFields(message, k, plan)
+		k = k + plan[3]
 		
-		response[msgprop[0]] = result
+		response[plan[0]] = result
 		
 	return response
-	
-	
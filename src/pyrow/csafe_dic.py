@@ -133,3 +133,9 @@ resp[0x1A05] = ['CSAFE_PM_SET_SPLITDURATION',		[0,]] 		#No variables returned !!
 resp[0x1A6B] = ['CSAFE_PM_GET_FORCEPLOTDATA',		[1, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2]]	#Bytes read, data ...
 resp[0x1A27] = ['CSAFE_PM_SET_SCREENERRORMODE',	[0,]]		#No variables returned !! double check
 resp[0x1A6C] = ['CSAFE_PM_GET_HEARTBEATDATA',		[1, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2]]	#Bytes read, data ...
+
+#Variable length responses, the data byte count in the reply decides the fields
+#resp_variable[0xCmd_Id] = Bytes per field (negative for a single ASCII field spanning the data)
+resp_variable = {}
+resp_variable[0x70] = 1		#CSAFE_GETCAPS_CMD, one byte per capability value
+resp_variable[0x92] = -1		#CSAFE_GETID_CMD, ASCII digits
@@ -12,6 +12,35 @@ import csafe_cmd
 import datetime
 import time
 import sys
+import os
+
+#Clock for frame gap deadlines and trace stamps. Python 2 has no time.monotonic, so on Linux
+#CLOCK_MONOTONIC is read through ctypes (it is system wide, so stamps from different processes
+#compare), and wall time is used anywhere else
+try:
+	monotonic = time.monotonic
+except AttributeError:
+	monotonic = time.time
+	if sys.platform.startswith('linux'):
+		try:
+			import ctypes
+			import ctypes.util
+
+			class timespec(ctypes.Structure):
+				_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+			clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True).clock_gettime
+			clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+			CLOCK_MONOTONIC = 1
+
+			def monotonic():
+				t = timespec()
+				if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+					errno = ctypes.get_errno()
+					raise OSError(errno, os.strerror(errno))
+				return t.tv_sec + t.tv_nsec * 1e-9
+		except (ImportError, OSError, AttributeError):
+			pass
 
 #move what I can into class?
 c2vendorID = 0x17a4
@@ -19,9 +48,22 @@ c2vendorID = 0x17a4
 #pm4prodID = 0x0002
 inEndpoint = 0x83  #EP3 poll rate of 8ms
 outEndpoint = 0x04 #EP4 poll rate of 4ms
-minframegap = .050 #in seconds
+minframegap = .050 #in seconds, used until the erg reports its own gap (see getErg)
+framegaplimits = (.010, 1.) #in seconds, what the erg reports is kept within these so a junk value can't remove the gap
 interface = 0
 
+#Fixed polling queries, encoded once at import (see csafe_cmd.Compile)
+monitorcmd = ['CSAFE_PM_GET_WORKTIME', 'CSAFE_PM_GET_WORKDISTANCE', 'CSAFE_GETCADENCE_CMD', 'CSAFE_GETPOWER_CMD', 'CSAFE_GETCALORIES_CMD', 'CSAFE_GETHRCUR_CMD']
+forceplotcmd = ['CSAFE_PM_GET_FORCEPLOTDATA', 32, 'CSAFE_PM_GET_STROKESTATE']
+strokecmd = ['CSAFE_PM_GET_WORKTIME', 'CSAFE_PM_GET_FORCEPLOTDATA', 32, 'CSAFE_PM_GET_STROKESTATE', 'CSAFE_PM_GET_WORKOUTSTATE']
+workoutcmd = ['CSAFE_GETID_CMD', 'CSAFE_PM_GET_WORKOUTTYPE', 'CSAFE_PM_GET_WORKOUTSTATE', 'CSAFE_PM_GET_INTERVALTYPE', 'CSAFE_PM_GET_WORKOUTINTERVALCOUNT']
+
+monitorframe = csafe_cmd.Compile(monitorcmd)
+monitorforceframe = csafe_cmd.Compile(monitorcmd + forceplotcmd)
+forceplotframe = csafe_cmd.Compile(forceplotcmd)
+strokeframe = csafe_cmd.Compile(strokecmd)
+workoutframe = csafe_cmd.Compile(workoutcmd)
+
 def find():
 	ergs = usb.core.find(find_all=True, idVendor=c2vendorID)
 	if ergs is None:
@@ -60,7 +102,14 @@ class pyrow:
 			pass
 		
 		this.erg = erg
-		this.__lastsend = datetime.datetime.now()
+		this.framegap = minframegap
+		this.__nextsend = monotonic() #earliest time the next frame may be sent
+		this.trace = None #monotonic times the last frame was written, its response read and decoded
+	
+	def close(this):
+		#Releases the usb interface and resources held for the erg
+		usb.util.release_interface(this.erg, interface)
+		usb.util.dispose_resources(this.erg)
 	
 	def __checkvalue(this, value, label, minimum, maximum):
 		#Checks that value is an integer and within the specified range
@@ -74,9 +123,7 @@ class pyrow:
 	def getMonitor(this, forceplot=False):
 		#Returns values from the monitor that relate to the current workout, optionally returns force plot data and stroke state
 		
-		command = ['CSAFE_PM_GET_WORKTIME', 'CSAFE_PM_GET_WORKDISTANCE', 'CSAFE_GETCADENCE_CMD', 'CSAFE_GETPOWER_CMD', 'CSAFE_GETCALORIES_CMD', 'CSAFE_GETHRCUR_CMD']
-		if forceplot: command.extend(['CSAFE_PM_GET_FORCEPLOTDATA', 32, 'CSAFE_PM_GET_STROKESTATE'])
-		results = this.send(command)
+		results = this.send(monitorforceframe if forceplot else monitorframe)
 		
 		monitor = {}
 		monitor['time'] = (results['CSAFE_PM_GET_WORKTIME'][0] + results['CSAFE_PM_GET_WORKTIME'][1])/100.
@@ -104,8 +151,7 @@ class pyrow:
 	def getForcePlot(this):
 		#Returns force plot data and stroke state
 		
-		command = ['CSAFE_PM_GET_FORCEPLOTDATA', 32, 'CSAFE_PM_GET_STROKESTATE']
-		results = this.send(command)
+		results = this.send(forceplotframe)
 		
 		forceplot = {}
 		datapoints = results['CSAFE_PM_GET_FORCEPLOTDATA'][0] // 2
@@ -117,11 +163,26 @@ class pyrow:
 		return forceplot
 
 	
+	def getStroke(this):
+		#Returns what is streamed while rowing in a single frame: work time, force plot data, stroke state and workout state
+		
+		results = this.send(strokeframe)
+		
+		stroke = {}
+		stroke['time'] = (results['CSAFE_PM_GET_WORKTIME'][0] + results['CSAFE_PM_GET_WORKTIME'][1])/100.
+		datapoints = results['CSAFE_PM_GET_FORCEPLOTDATA'][0] // 2
+		stroke['forceplot'] = results['CSAFE_PM_GET_FORCEPLOTDATA'][1:(datapoints+1)]
+		stroke['strokestate'] = results['CSAFE_PM_GET_STROKESTATE'][0]
+		stroke['state'] = results['CSAFE_PM_GET_WORKOUTSTATE'][0]
+		
+		stroke['status'] = results['CSAFE_GETSTATUS_CMD'][0] & 0xF
+		
+		return stroke
+	
 	def getWorkout(this):
 		#Returns overall workout data  
 		
-		command = ['CSAFE_GETID_CMD', 'CSAFE_PM_GET_WORKOUTTYPE', 'CSAFE_PM_GET_WORKOUTSTATE', 'CSAFE_PM_GET_INTERVALTYPE', 'CSAFE_PM_GET_WORKOUTINTERVALCOUNT']
-		results = this.send(command)
+		results = this.send(workoutframe)
 		
 		workoutdata = {}
 		workoutdata['userid'] = results['CSAFE_GETID_CMD'][0]
@@ -153,7 +214,9 @@ class pyrow:
 		#Get data from csafe get capabilities command
 		ergdata['maxrx'] = results['CSAFE_GETCAPS_CMD'][0]
 		ergdata['maxtx'] = results['CSAFE_GETCAPS_CMD'][1]
-		ergdata['mininterframe'] = results['CSAFE_GETCAPS_CMD'][2]
+		ergdata['mininterframe'] = results['CSAFE_GETCAPS_CMD'][2] if len(results['CSAFE_GETCAPS_CMD']) > 2 else 0
+		if ergdata['mininterframe']: #reported in milliseconds, 0 (or missing) keeps the gap we have
+			this.framegap = min(max(ergdata['mininterframe'] / 1000., framegaplimits[0]), framegaplimits[1])
 
 		ergdata['status'] = results['CSAFE_GETSTATUS_CMD'][0] & 0xF
 		
@@ -229,24 +292,34 @@ class pyrow:
 		
 		this.send(command)
 
+	def getSendDelay(this):
+		#Returns seconds until the erg will accept the next frame, callers can use this to do other work
+		#(encoding, flushing clients) before calling send instead of sleeping through the frame gap
+		
+		#clamped to the gap in case the clock steps backwards (only possible off Linux on Python 2, where wall time is used)
+		return max(0., min(this.__nextsend - monotonic(), this.framegap))
+	
 	def send(this, message):
 		#Converts and sends message to erg; recieves, converts, and returns ergs response
+		#message is either a command list or a frame precompiled with csafe_cmd.Compile
 		
-		#Checks that enought time has passed since the last message was sent, if not program sleeps till time has passed
-		now = datetime.datetime.now()
-		delta = now - this.__lastsend
-		deltaraw = delta.seconds + delta.microseconds/1000000.
-		if deltaraw < minframegap:
-			time.sleep(minframegap - deltaraw)
-		
+		#Sleeps only for whatever is left of the frame gap since the last message was sent
+		delay = this.getSendDelay()
+		if delay > 0:
+			time.sleep(delay)
 		
-		csafe = csafe_cmd.Write(message) #convert message to byte array
+		if isinstance(message, bytes):
+			csafe = message #already encoded
+		else:
+			csafe = csafe_cmd.Write(message) #convert message to byte array
+		written = monotonic()
 		length = this.erg.write(outEndpoint, csafe) #sends message to erg and records length of message
-		this.__lastsend = datetime.datetime.now() #records time when message was sent
-		try:
-			response = this.erg.read(inEndpoint, length) #recieves byte array from erg
-		except:
-			return [] #ToDo: Replace with error or let error trigger? #No message was recieved back from erg
+		this.__nextsend = monotonic() + this.framegap #records when the next message may be sent
+		response = this.erg.read(inEndpoint, length) #recieves byte array from erg, usb errors are left to the caller
+		received = monotonic()
 			
 		returned = csafe_cmd.Read(response) #convers byte array to response dictionary
+		if not returned:
+			raise IOError("Invalid response from erg")
+		this.trace = (written, received, monotonic())
 		return returned
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+#Simulated PM3/PM4 for running pyrow without libusb or a monitor. A Device stands in for the usb.core.Device that
+#pyrow.pyrow is given: frames written to it are parsed byte for byte (report IDs, wrappers, byte stuffing and
+#checksums) and answered with correctly stuffed and checksummed responses, after a configurable latency. Frames
+#sent before the frame gap has passed are dropped as a monitor does, so the read after them times out.
+#
+#	erg = pyrow.pyrow(usbsim.Device(framegap=0))
+#	erg.getMonitor()
+
+import csafe_dic
+import errno
+import time
+from functools import reduce
+from operator import xor
+from pyrow import monotonic #the frame gap is timed on the same clock as pyrow's
+
+c2vendorID = 0x17a4
+inEndpoint = 0x83
+outEndpoint = 0x04
+
+#Report ID -> report length including the ID byte
+reports = {0x01: 21, 0x04: 63, 0x02: 121}
+
+#Status byte: frame toggle, previous frame status and the state of the monitor
+frametoggle = 0x80
+frameok = 0x00
+framereject = 0x10
+stateready = 1
+stateidle = 2
+statehaveid = 3
+stateinuse = 5
+statefinished = 7
+
+#Monitor state after each state command
+statecmds = {0x81: stateready, 0x82: stateidle, 0x83: statehaveid, 0x85: stateinuse, 0x86: statefinished, 0x87: stateready}
+
+#Workout and stroke states reported by a PM
+workoutwaiting = 0
+workoutrowing = 1
+strokedrive = 2
+strokerecovery = 4
+
+forcesampleinterval = .01 #seconds between force plot samples during the drive
+forceblocksamples = 16 #samples a single force plot response can hold
+
+wrapperid = csafe_dic.cmds['CSAFE_SETUSERCFG1_CMD'][0]
+
+def find(count=1, **options):
+	#Returns simulated ergs in place of pyrow.find, each with its own address and serial number
+	return [Device(address=n + 1, serial=str(300000001 + n), **options) for n in range(count)]
+
+def stuff(message):
+	#Returns message with every flag value (0xF0-0xF3) replaced by the stuffing flag and its low two bits
+	stuffed = bytearray()
+	for byte in message:
+		if 0xF0 <= byte <= 0xF3:
+			stuffed.append(csafe_dic.Byte_Stuffing_Flag)
+			stuffed.append(byte & 0x3)
+		else:
+			stuffed.append(byte)
+
+	return stuffed
+
+def unstuff(message):
+	#Reverses stuff, None if a stuffing flag is not followed by a valid value
+	unstuffed = bytearray()
+	escaped = False
+	for byte in message:
+		if escaped:
+			if byte > 0x3:
+				return None
+			unstuffed.append(0xF0 | byte)
+			escaped = False
+		elif byte == csafe_dic.Byte_Stuffing_Flag:
+			escaped = True
+		else:
+			unstuffed.append(byte)
+
+	return None if escaped else unstuffed
+
+
+class Context:
+	#Stands in for the libusb backend context that usb.util calls through (claim/release interface, dispose)
+
+	def __init__(this):
+		this.claimed = set()
+
+	def managed_claim_interface(this, device, interface):
+		this.claimed.add(interface)
+
+	def managed_release_interface(this, device, interface):
+		this.claimed.discard(interface)
+
+	def dispose(this, device):
+		this.claimed.clear()
+
+
+class Device:
+
+	def __init__(this, serial='300000001', model=3, latency=0., framegap=.050, step=None, bus=0, address=1):
+		#latency is the seconds from a frame being written until its response can be read, framegap the
+		#seconds the monitor needs between frames (reported through CSAFE_GETCAPS_CMD, 0 disables the check).
+		#With step set the erg's clock moves on step seconds for every frame instead of following wall time,
+		#so a session plays back the same way however fast it is polled
+		this.idVendor = c2vendorID
+		this.idProduct = 0x0001 if model == 3 else 0x0002
+		this.bus = bus
+		this.address = address
+		this._ctx = Context()
+		this.kerneldriver = True
+		this.configured = False
+
+		this.serial = serial
+		this.model = model
+		this.latency = latency
+		this.framegap = framegap
+		this.step = step
+
+		this.status = stateready
+		this.toggle = 0
+		this.lastwrite = None
+		this.response = None
+		this.ready = 0 #when the response can be read
+
+		#counters, for tests and benchmarks
+		this.frames = 0 #frames answered
+		this.rejected = 0 #frames with an unknown command
+		this.dropped = 0 #frames that were not answered (bad frames or sent inside the frame gap)
+
+		#workout
+		this.clock = 0.
+		this.userid = '00000'
+		this.workouttype = 0
+		this.workoutstate = workoutwaiting
+		this.rowing = None #(start, spm, power, samples, heartrate)
+		this.stroke = -1 #stroke the force plot samples belong to
+		this.delivered = 0 #samples of it read so far
+
+	#usb.core.Device calls made by pyrow
+
+	def is_kernel_driver_active(this, interface):
+		return this.kerneldriver
+
+	def detach_kernel_driver(this, interface):
+		this.kerneldriver = False
+
+	def set_configuration(this, configuration=None):
+		this.configured = True
+
+	def write(this, endpoint, data, timeout=None):
+		if endpoint != outEndpoint:
+			raise IOError(errno.EPIPE, "Not an out endpoint: 0x{0:02X}".format(endpoint))
+
+		now = monotonic()
+		early = this.lastwrite is not None and now - this.lastwrite < this.framegap
+		this.lastwrite = now
+
+		this.response = None
+		frame = bytearray(data)
+		if early:
+			this.dropped += 1
+		else:
+			this.response = this.receive(frame)
+			this.ready = now + this.latency
+
+		return len(frame)
+
+	def read(this, endpoint, size, timeout=None):
+		if endpoint != inEndpoint:
+			raise IOError(errno.EPIPE, "Not an in endpoint: 0x{0:02X}".format(endpoint))
+
+		response = this.response
+		this.response = None
+		if response is None:
+			raise IOError(errno.ETIMEDOUT, "Operation timed out")
+		if len(response) > size:
+			raise IOError(errno.EOVERFLOW, "Overflow")
+
+		delay = this.ready - monotonic()
+		if delay > 0:
+			time.sleep(delay)
+		return response
+
+	#Rowing
+
+	def row(this, spm=24, power=200, samples=60, heartrate=0):
+		#Starts a steady piece: every stroke has a drive of samples force plot samples at the same rate and power
+		this.rowing = (this.now(), float(spm), float(power), samples, heartrate)
+		this.workoutstate = workoutrowing
+		this.status = stateinuse
+		this.stroke = -1
+		this.delivered = 0
+
+	def now(this):
+		if this.step is None:
+			return monotonic()
+		return this.clock
+
+	def worktime(this):
+		if this.rowing is None:
+			return 0.
+		return max(0., this.now() - this.rowing[0])
+
+	def monitor(this):
+		#Returns (work time, distance, calories) so far
+		t = this.worktime()
+		if this.rowing is None:
+			return t, 0., 0
+		power = this.rowing[2]
+		pace = ((2.8 / power) ** (1./3)) * 500
+		calhr = power * (4.0 * 0.8604) + 300.
+		return t, 500. * t / pace, int(calhr * t / 3600.)
+
+	def strokeposition(this):
+		#Returns (stroke number, samples of its drive so far, stroke state)
+		if this.rowing is None:
+			return -1, 0, strokerecovery
+		start, spm, power, samples, heartrate = this.rowing
+		period = 60. / spm
+		t = this.worktime()
+		stroke = int(t // period)
+		released = int((t - stroke * period) / forcesampleinterval) + 1
+		if released > samples:
+			return stroke, samples, strokerecovery
+		return stroke, released, strokedrive
+
+	def forceplot(this, blocklength):
+		#Returns the samples released since the last read, at most blocklength bytes worth
+		stroke, released, state = this.strokeposition()
+		if stroke != this.stroke:
+			this.stroke = stroke
+			this.delivered = 0
+		if stroke < 0:
+			return []
+
+		start, spm, power, samples, heartrate = this.rowing
+		count = max(0, min(released - this.delivered, blocklength // 2, forceblocksamples))
+		peak = power * .6
+		curve = [int(peak * (4. * (n + .5) / samples) * (1. - (n + .5) / samples)) for n in range(this.delivered, this.delivered + count)]
+		this.delivered += count
+		return curve
+
+	#Frames
+
+	def receive(this, frame):
+		#Returns the response report to a frame written to the erg, None if a monitor would ignore the frame
+		if not frame or frame[0] not in reports:
+			this.dropped += 1
+			return None
+		reportid = frame[0]
+
+		start = frame[1] if len(frame) > 1 else None
+		if start == csafe_dic.Standard_Frame_Start_Flag:
+			addresses = None
+			j = 2
+		elif start == csafe_dic.Extended_Frame_Start_Flag:
+			addresses = frame[2:4]
+			j = 4
+		else:
+			this.dropped += 1
+			return None
+
+		stop = frame.find(bytearray([csafe_dic.Stop_Frame_Flag]), j)
+		message = unstuff(frame[j:stop]) if stop >= 0 else None
+		if not message or reduce(xor, message, 0) != 0:
+			this.dropped += 1
+			return None
+
+		if this.step is not None:
+			this.clock += this.step
+
+		commands = this.parse(message[:-1], 0)
+		if commands is None:
+			this.dropped += 1
+			return None
+
+		prevstatus = frameok
+		try:
+			data = this.respond(commands)
+		except KeyError:
+			this.rejected += 1
+			prevstatus = framereject
+			data = bytearray()
+
+		this.frames += 1
+		this.toggle ^= frametoggle
+		message = bytearray([this.toggle | prevstatus | this.status]) + data
+		message.append(reduce(xor, message, 0))
+
+		response = bytearray([start])
+		if addresses is not None:
+			response += addresses[::-1] #answered from the address it was sent to
+		response += stuff(message)
+		response.append(csafe_dic.Stop_Frame_Flag)
+
+		#answered in the same report if it fits, otherwise the smallest one that does
+		for responseid in [reportid] + sorted(reports, key=reports.get):
+			if len(response) + 1 <= reports[responseid]:
+				break
+		else:
+			this.dropped += 1
+			return None
+
+		report = bytearray([responseid]) + response
+		return report + bytearray(reports[responseid] - len(report))
+
+	def parse(this, message, wrapper):
+		#Returns the commands in a message as [(command id, data or wrapped commands)], None if malformed.
+		#Ids inside a wrapper are qualified with the wrapper like csafe_dic.resp (0x1AA0 for a PM work time)
+		commands = []
+		k = 0
+		while k < len(message):
+			cmdid = message[k]
+			if cmdid >= 0x80: #short commands have no data
+				commands.append((wrapper | cmdid, None))
+				k += 1
+				continue
+
+			if k + 1 >= len(message) or k + 2 + message[k + 1] > len(message):
+				return None
+			data = message[k + 2:k + 2 + message[k + 1]]
+			k += 2 + len(data)
+
+			if cmdid == wrapperid and not wrapper:
+				wrapped = this.parse(data, wrapperid << 8)
+				if wrapped is None:
+					return None
+				commands.append((cmdid, wrapped))
+			else:
+				commands.append((wrapper | cmdid, data))
+
+		return commands
+
+	def respond(this, commands):
+		#Returns the response data to a list of commands, raising KeyError for a command the erg doesn't know.
+		#Commands that return no data are left out of the response, as are wrappers with nothing left in them
+		data = bytearray()
+		for cmdid, argument in commands:
+			if cmdid == wrapperid:
+				wrapped = this.respond(argument)
+				if wrapped:
+					data += bytearray([wrapperid, len(wrapped)]) + wrapped
+				continue
+
+			fields = csafe_dic.resp[cmdid][1]
+			if cmdid in statecmds:
+				this.status = statecmds[cmdid]
+
+			values = this.values(cmdid, argument)
+			if values is None:
+				continue
+
+			if cmdid in csafe_dic.resp_variable:
+				if csafe_dic.resp_variable[cmdid] < 0:
+					encoded = bytearray(values[0].encode('ascii'))
+				else:
+					encoded = bytearray(values)
+			else:
+				encoded = bytearray()
+				for numbytes, value in zip(fields, values):
+					if numbytes < 0:
+						encoded += bytearray(value.encode('ascii')[:-numbytes].ljust(-numbytes, b'\0'))
+					else:
+						encoded += bytearray([(int(value) >> (8 * n)) & 0xFF for n in range(numbytes)])
+
+			data += bytearray([cmdid & 0xFF, len(encoded)]) + encoded
+
+		return data
+
+	def values(this, cmdid, argument):
+		#Returns the response fields to a command (see csafe_dic.resp), None for commands that return no data
+		if sum([abs(numbytes) for numbytes in csafe_dic.resp[cmdid][1]]) == 0:
+			return None
+
+		t, distance, calories = this.monitor()
+		spm, power, heartrate = (0, 0, 0) if this.rowing is None else (int(this.rowing[1]), int(this.rowing[2]), this.rowing[4])
+
+		if cmdid == 0x91: #version
+			return [22, 0, this.model, 0, 0]
+		if cmdid == 0x92: #id
+			return [this.userid]
+		if cmdid == 0x93: #units
+			return [36]
+		if cmdid == 0x94: #serial
+			return [this.serial]
+		if cmdid == 0x9B: #odometer
+			return [int(distance), 36]
+		if cmdid == 0x9C: #error code
+			return [0]
+		if cmdid == 0xA0: #work time
+			return [int(t // 3600), int(t // 60) % 60, int(t) % 60]
+		if cmdid == 0xA1: #horizontal distance
+			return [int(distance), 36]
+		if cmdid == 0xA3: #calories
+			return [calories]
+		if cmdid == 0xA4: #program
+			return [0]
+		if cmdid == 0xA6: #pace, seconds per km
+			return [int(2. * ((2.8 / power) ** (1./3)) * 500) if power else 0, 57]
+		if cmdid == 0xA7: #cadence
+			return [spm, 84]
+		if cmdid == 0xAB: #user info
+			return [0, 39, 0, 0]
+		if cmdid == 0xB0: #heart rate
+			return [heartrate]
+		if cmdid == 0xB4: #power
+			return [power, 88]
+		if cmdid == 0x70: #capabilities
+			if argument and argument[0] == 0x00:
+				return [reports[0x02], reports[0x02], int(round(this.framegap * 1000))]
+			return [0]
+
+		if cmdid == 0x1A89: #workout type
+			return [this.workouttype]
+		if cmdid == 0x1AC1: #drag factor
+			return [120]
+		if cmdid == 0x1ABF: #stroke state
+			return [this.strokeposition()[2]]
+		if cmdid == 0x1AA0: #work time in hundredths
+			return [int(round(t * 100)), 0]
+		if cmdid == 0x1AA3: #work distance in tenths
+			return [int(distance * 10), 0]
+		if cmdid == 0x1AC9: #error value
+			return [0]
+		if cmdid == 0x1A8D: #workout state
+			return [this.workoutstate]
+		if cmdid == 0x1A9F: #interval count
+			return [0]
+		if cmdid == 0x1A8E: #interval type
+			return [0]
+		if cmdid == 0x1ACF: #rest time
+			return [0]
+		if cmdid == 0x1A6B: #force plot data
+			curve = this.forceplot(argument[0] if argument else 0)
+			return [2 * len(curve)] + curve + [0] * (forceblocksamples - len(curve))
+		if cmdid == 0x1A6C: #heart beat data
+			return [0] * (forceblocksamples + 1)
+
+		raise KeyError(cmdid)
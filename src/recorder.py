@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+# Records every stroke (monitor snapshot and full force curve) and workout event
+# to an append-only binary log, one file per erg and workout session. Messages
+# are handed to a background writer, so recording never holds up the server,
+# and the files are fsynced in batches.
+#
+# Run with a log file to print its records as json: python recorder.py FILE
+
+# ==============================================================================
+# IMPORTS
+# ==============================================================================
+
+import collections
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+# ==============================================================================
+# LOG FORMAT
+# ==============================================================================
+
+# a log starts with LOG_MAGIC, then records of a fixed header followed by
+# its payload, all little-endian:
+#   uint32 payload length, uint8 record type, uint8 reserved, float64 wall time
+LOG_MAGIC = b'ERGLOG\x00\x01'
+LOG_EXTENSION = '.erglog'
+RECORD_HEADER = struct.Struct('<IBBd')
+
+RECORD_SESSION = 0          # json: erg_id, first message type
+RECORD_STROKE = 1           # STROKE_END, see STROKE_RECORD
+RECORD_WORKOUT_START = 2    # json content of the message
+RECORD_WORKOUT_END = 3      # json content of the message
+
+# a stroke is its monitor snapshot, then the force curve as uint16 samples:
+#   uint32 stroke id, float64 time, float64 distance, float32 pace, float32 calhr,
+#   uint16 spm, uint16 power, uint16 calories, uint8 heartrate, uint8 status, uint16 samples
+STROKE_RECORD = struct.Struct('<IddffHHHBBH')
+
+RECORD_TYPES = {
+    "STROKE_END": RECORD_STROKE,
+    "WORKOUT_START": RECORD_WORKOUT_START,
+    "WORKOUT_END": RECORD_WORKOUT_END,
+}
+RECORD_NAMES = dict((record_type, name) for name, record_type in RECORD_TYPES.items())
+RECORD_NAMES[RECORD_SESSION] = "SESSION"
+
+# seconds between fsyncs of the open logs
+FSYNC_INTERVAL = 1.0
+
+def encode_record(record_type, payload, wall_time):
+    return RECORD_HEADER.pack(len(payload), record_type, 0, wall_time) + payload
+
+def encode_stroke(content):
+    monitor = content['monitor']
+    forceplot = content['forceplot']
+    data = STROKE_RECORD.pack(content['stroke_id'], monitor['time'], monitor['distance'], monitor['pace'], monitor['calhr'],
+                              monitor['spm'], monitor['power'], monitor['calories'], monitor['heartrate'], monitor['status'],
+                              len(forceplot))
+    return data + struct.pack('<%dH' % len(forceplot), *forceplot)
+
+def decode_stroke(payload, erg_id=None):
+    (stroke_id, stroke_time, distance, pace, calhr, spm, power, calories, heartrate, status, samples) = STROKE_RECORD.unpack_from(payload)
+    monitor = { 'time': stroke_time, 'distance': distance, 'pace': pace, 'calhr': calhr, 'spm': spm, 'power': power,
+                'calories': calories, 'heartrate': heartrate, 'status': status }
+    forceplot = list(struct.unpack_from('<%dH' % samples, payload, STROKE_RECORD.size))
+    return { 'erg_id': erg_id, 'stroke_id': stroke_id, 'monitor': monitor, 'forceplot': forceplot }
+
+# ==============================================================================
+# WRITING
+# ==============================================================================
+
+# picks the strokes and workout events out of the server's messages and
+# appends them to a log per erg session on a background thread
+class SessionRecorder(threading.Thread):
+
+    def __init__(self, directory, fsync_interval=FSYNC_INTERVAL):
+        super(SessionRecorder, self).__init__()
+        self.daemon = True
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+
+        self.pending = collections.deque()  # (wall time, message) waiting to be written
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+        # writer thread only
+        self.sessions = {}  # open log file for each erg_id
+        self.dirty = set()  # files written since their last fsync
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    # called by the server for every message, only ever appends to a deque
+    def record(self, message):
+        if message['type'] in RECORD_TYPES or message['type'] == "ERG_HEALTH":
+            self.pending.append((time.time(), message))
+            if message['type'] != "STROKE_END":
+                self.wakeup.set()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.join(self.fsync_interval + 5.0)
+
+    def run(self):
+        last_sync = time.time()
+        while True:
+            stopped = self.stopped
+            if not stopped:
+                self.wakeup.wait(self.fsync_interval)
+                self.wakeup.clear()
+
+            while self.pending:
+                wall_time, message = self.pending.popleft()
+                try:
+                    self.write(wall_time, message)
+                except Exception as e:
+                    print("[RECORD] could not record {}: {}".format(message['type'], e))
+
+            now = time.time()
+            if stopped or now - last_sync >= self.fsync_interval:
+                self.sync()
+                last_sync = now
+
+            if stopped:
+                for erg_id in list(self.sessions.keys()):
+                    self.end(erg_id)
+                return
+
+    def write(self, wall_time, message):
+        content = message['content']
+        erg_id = content.get('erg_id')
+        if erg_id is None:
+            return
+
+        # a stopped monitor ends its session
+        if message['type'] == "ERG_HEALTH":
+            if 'error' in content:
+                self.end(erg_id)
+            return
+
+        log = self.sessions.get(erg_id)
+        if log is None or message['type'] == "WORKOUT_START":
+            # strokes without a WORKOUT_START (the server started mid workout) still get a session
+            self.end(erg_id)
+            log = self.begin(erg_id, wall_time, message['type'])
+
+        record_type = RECORD_TYPES[message['type']]
+        if record_type == RECORD_STROKE:
+            payload = encode_stroke(content)
+        else:
+            payload = json.dumps(content).encode('utf-8')
+        log.write(encode_record(record_type, payload, wall_time))
+        self.dirty.add(log)
+
+        if record_type == RECORD_WORKOUT_END:
+            self.end(erg_id)
+
+    def begin(self, erg_id, wall_time, first_type):
+        name = "{}-{}{}".format(erg_id, time.strftime("%Y%m%d-%H%M%S", time.localtime(wall_time)), LOG_EXTENSION)
+        path = os.path.join(self.directory, name)
+        new = not os.path.exists(path)
+        log = open(path, 'ab')
+        if new:
+            log.write(LOG_MAGIC)
+        log.write(encode_record(RECORD_SESSION, json.dumps({ 'erg_id': erg_id, 'first': first_type }).encode('utf-8'), wall_time))
+        self.sessions[erg_id] = log
+        print("[RECORD] recording erg {} to {}".format(erg_id, path))
+        return log
+
+    def end(self, erg_id):
+        log = self.sessions.pop(erg_id, None)
+        if log is not None:
+            self.dirty.discard(log)
+            log.flush()
+            os.fsync(log.fileno())
+            log.close()
+
+    def sync(self):
+        for log in self.dirty:
+            log.flush()
+            os.fsync(log.fileno())
+        self.dirty.clear()
+
+# ==============================================================================
+# READING
+# ==============================================================================
+
+# reads a log through a memory map, iterating over (type name, wall time, content).
+# a record cut short (the server was killed while writing) ends the log
+class SessionLog(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self.file.close()
+            raise
+        if self.map[:len(LOG_MAGIC)] != LOG_MAGIC:
+            self.close()
+            raise ValueError("{} is not an erg session log".format(path))
+        self.erg_id = None
+
+    def __iter__(self):
+        offset = len(LOG_MAGIC)
+        end = len(self.map)
+        while offset + RECORD_HEADER.size <= end:
+            length, record_type, reserved, wall_time = RECORD_HEADER.unpack_from(self.map, offset)
+            start = offset + RECORD_HEADER.size
+            if start + length > end:
+                return
+            payload = self.map[start:start + length]
+            offset = start + length
+
+            if record_type == RECORD_STROKE:
+                content = decode_stroke(payload, self.erg_id)
+            else:
+                content = json.loads(payload.decode('utf-8'))
+                if record_type == RECORD_SESSION:
+                    self.erg_id = content['erg_id']
+            yield RECORD_NAMES.get(record_type, record_type), wall_time, content
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def main():
+    if len(sys.argv) != 2:
+        print("usage: {} FILE".format(sys.argv[0]))
+        sys.exit(1)
+
+    with SessionLog(sys.argv[1]) as log:
+        for name, wall_time, content in log:
+            print(json.dumps({ 'type': name, 'time': wall_time, 'content': content }))
+
+if __name__ == "__main__":
+    main()
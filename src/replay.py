@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+# Stand-in ergs for running the server without a Concept 2 on usb. A ReplayErg
+# answers the same calls as pyrow.pyrow (getErg, getWorkout, getStroke,
+# getMonitor, getForcePlot), playing back a recorded session (see recorder.py)
+# or a synthetic one on a virtual clock: in real time, N times faster, or as
+# fast as it is polled (which is also fully deterministic).
+
+# ==============================================================================
+# IMPORTS
+# ==============================================================================
+
+import math
+import random
+import pyrow.pyrow as pyrow     # for its clock
+from recorder import SessionLog
+
+# ==============================================================================
+# CONSTANTS
+# ==============================================================================
+
+FORCE_SAMPLE_INTERVAL = 0.01    # virtual seconds between force samples during the drive
+FORCE_CHUNK = 16                # most samples the erg returns per poll (32 bytes of force plot data)
+
+# virtual seconds waiting for the workout to begin, after the last stroke before
+# it ends, and between the end and starting over when looping
+WAIT_TIME = 1.0
+END_TIME = 1.0
+LOOP_PAUSE = 2.0
+
+# virtual seconds each poll moves the clock on when replaying as fast as possible (speed 0)
+FAST_STEP = FORCE_CHUNK * FORCE_SAMPLE_INTERVAL
+
+# erg states as reported by a PM
+WORKOUT_WAITING = 0
+WORKOUT_ROWING = 1
+WORKOUT_END = 10
+STROKE_DRIVE = 2
+STROKE_RECOVERY = 4
+STATUS_READY = 1
+STATUS_IN_USE = 5
+STATUS_FINISHED = 7
+
+# ==============================================================================
+# SESSIONS
+# ==============================================================================
+
+# sessions are dicts of the erg_id, the workout, the monitor at the start and end,
+# and the strokes as (seconds from the workout start to the end of the drive, monitor, forceplot)
+
+def load_session(path):
+    erg_id = None
+    start = None
+    workout = None
+    start_monitor = None
+    end_monitor = None
+    strokes = []
+
+    with SessionLog(path) as log:
+        for name, wall_time, content in log:
+            if name == "SESSION":
+                erg_id = content['erg_id']
+            elif name == "WORKOUT_START":
+                start = wall_time
+                workout = content['workout']
+                start_monitor = content['monitor']
+            elif name == "STROKE_END":
+                # recorded mid workout, so start just before the first drive
+                if start is None:
+                    start = wall_time - len(content['forceplot']) * FORCE_SAMPLE_INTERVAL - 1.0
+                strokes.append((wall_time - start, content['monitor'], content['forceplot']))
+            elif name == "WORKOUT_END":
+                end_monitor = content['monitor']
+
+    if not strokes:
+        raise ValueError("{} has no strokes to replay".format(path))
+
+    if workout is None:
+        workout = { 'userid': '0', 'type': 0, 'state': WORKOUT_ROWING, 'inttype': 0, 'intcount': 0, 'status': STATUS_IN_USE }
+    if start_monitor is None:
+        start_monitor = dict(strokes[0][1], time=0.0, distance=0.0, spm=0, power=0, pace=0, calhr=0, calories=0)
+    if end_monitor is None:
+        end_monitor = strokes[-1][1]
+
+    return { 'erg_id': erg_id, 'workout': workout, 'start': start_monitor, 'end': end_monitor, 'strokes': strokes }
+
+# a steady piece with some stroke to stroke variation, the same every time for a seed
+def synthetic_session(strokes=250, spm=24.0, power=200.0, samples=60, erg_id='900000001', seed=0):
+    rnd = random.Random(seed)
+    period = 60.0 / spm
+    drive = samples * FORCE_SAMPLE_INTERVAL
+
+    session_strokes = []
+    distance = 0.0
+    calories = 0.0
+    for index in range(strokes):
+        stroke_power = power * rnd.uniform(0.9, 1.1)
+        pace = ((2.8 / stroke_power) ** (1. / 3)) * 500
+        calhr = stroke_power * (4.0 * 0.8604) + 300.
+        distance += 500.0 / pace * period
+        calories += calhr * period / 3600.0
+        end = index * period + drive
+
+        monitor = { 'time': round(end, 2), 'distance': round(distance, 1), 'spm': int(round(spm)), 'power': int(round(stroke_power)),
+                    'pace': pace, 'calhr': calhr, 'calories': int(calories), 'heartrate': 0, 'status': STATUS_IN_USE }
+
+        # a half sine, peaking a little early like a real drive
+        peak = stroke_power * rnd.uniform(0.55, 0.65)
+        forceplot = [int(round(peak * math.sin(math.pi * ((i + 0.5) / samples) ** 0.8))) for i in range(samples)]
+
+        session_strokes.append((end, monitor, forceplot))
+
+    workout = { 'userid': '0', 'type': 0, 'state': WORKOUT_ROWING, 'inttype': 0, 'intcount': 0, 'status': STATUS_IN_USE }
+    start_monitor = { 'time': 0.0, 'distance': 0.0, 'spm': 0, 'power': 0, 'pace': 0, 'calhr': 0, 'calories': 0, 'heartrate': 0, 'status': STATUS_IN_USE }
+    return { 'erg_id': erg_id, 'workout': workout, 'start': start_monitor, 'end': session_strokes[-1][1], 'strokes': session_strokes }
+
+# ==============================================================================
+# REPLAY ERG
+# ==============================================================================
+
+# plays a session back through the pyrow.pyrow interface. the workout waits
+# WAIT_TIME, then each stroke's drive hands out its force samples as the erg
+# would (at most FORCE_CHUNK per poll), then the workout ends. strokes are
+# never skipped, if polls fall behind the replay catches up a chunk at a time
+class ReplayErg(object):
+
+    trace = None    # no usb reads to trace (see pyrow.send)
+
+    def __init__(self, session, speed=1.0, loop=False, serial=None):
+        self.session = session
+        self.speed = speed      # 0 = as fast as it is polled
+        self.loop = loop
+        self.serial = serial or session['erg_id']
+
+        # (drive start, drive end, monitor, forceplot) in virtual seconds
+        self.strokes = []
+        previous = WAIT_TIME
+        for offset, monitor, forceplot in session['strokes']:
+            end = max(WAIT_TIME + offset, previous + FORCE_SAMPLE_INTERVAL)
+            start = max(end - len(forceplot) * FORCE_SAMPLE_INTERVAL, previous)
+            self.strokes.append((start, end, monitor, forceplot))
+            previous = end
+        self.end_time = previous + END_TIME
+
+        self.restart()
+
+    def restart(self):
+        self.origin = None      # the clock starts on the first poll
+        self.virtual = 0.0
+        self.stroke_index = 0   # next stroke that hasn't been fully handed out
+        self.delivered = 0      # samples of it handed out so far
+
+    # virtual seconds since the session (re)started
+    def now(self, poll=False):
+        if self.speed > 0:
+            if self.origin is None:
+                self.origin = pyrow.monotonic()
+            return (pyrow.monotonic() - self.origin) * self.speed
+
+        if poll:
+            self.virtual += FAST_STEP
+        return self.virtual
+
+    def workoutState(self, t):
+        if t < WAIT_TIME:
+            return WORKOUT_WAITING
+        if t < self.end_time or self.stroke_index < len(self.strokes):
+            return WORKOUT_ROWING
+        return WORKOUT_END
+
+    # the force samples for this poll and the stroke state
+    def pull(self, t):
+        if self.stroke_index >= len(self.strokes):
+            return [], STROKE_RECOVERY
+
+        start, end, monitor, forceplot = self.strokes[self.stroke_index]
+        if t < start:
+            return [], STROKE_RECOVERY
+
+        released = min(len(forceplot), int((t - start) / FORCE_SAMPLE_INTERVAL) + 1)
+        first = self.delivered == 0
+        chunk = forceplot[self.delivered:min(released, self.delivered + FORCE_CHUNK)]
+        self.delivered += len(chunk)
+
+        # the first poll of a stroke is always in the drive so the stroke can't be missed
+        if first or self.delivered < len(forceplot) or t < end:
+            return chunk, STROKE_DRIVE
+
+        self.stroke_index += 1
+        self.delivered = 0
+        return chunk, STROKE_RECOVERY
+
+    def status(self, state):
+        if state == WORKOUT_WAITING:
+            return STATUS_READY
+        if state == WORKOUT_ROWING:
+            return STATUS_IN_USE
+        return STATUS_FINISHED
+
+    def getErg(self):
+        return { 'mfgid': 0, 'cid': 0, 'model': 'replay', 'hwversion': 0, 'swversion': 0, 'serial': self.serial,
+                 'maxrx': 0, 'maxtx': 0, 'mininterframe': 0, 'status': STATUS_READY }
+
+    def getWorkout(self):
+        t = self.now(poll=True)
+        # the monitor is idle once the workout ends, so as fast as possible starts over straight away
+        pause = LOOP_PAUSE if self.speed > 0 else 0
+        if self.loop and self.workoutState(t) == WORKOUT_END and t >= self.end_time + pause:
+            self.restart()
+            t = self.now(poll=True)
+
+        state = self.workoutState(t)
+        workout = dict(self.session['workout'])
+        workout['state'] = state
+        workout['status'] = self.status(state)
+        return workout
+
+    def getStroke(self):
+        t = self.now(poll=True)
+        forceplot, strokestate = self.pull(t)
+        state = self.workoutState(t)
+        return { 'time': round(max(0.0, t - WAIT_TIME), 2), 'forceplot': forceplot, 'strokestate': strokestate,
+                 'state': state, 'status': self.status(state) }
+
+    def getForcePlot(self):
+        t = self.now(poll=True)
+        forceplot, strokestate = self.pull(t)
+        return { 'forceplot': forceplot, 'strokestate': strokestate, 'status': self.status(self.workoutState(t)) }
+
+    # the monitor as of the last finished stroke
+    def getMonitor(self, forceplot=False):
+        t = self.now()
+        if self.workoutState(t) == WORKOUT_END:
+            monitor = dict(self.session['end'])
+        elif self.stroke_index > 0:
+            monitor = dict(self.strokes[self.stroke_index - 1][2])
+        else:
+            monitor = dict(self.session['start'])
+
+        if forceplot:
+            monitor['forceplot'], monitor['strokestate'] = self.pull(self.now(poll=True))
+        monitor['status'] = self.status(self.workoutState(t))
+        return monitor
+
+    # no frame gap to wait for
+    def getSendDelay(self):
+        return 0.0
+
+    def close(self):
+        pass
+
+# stands in for a usb device, so the supervisor attaches replays like real ergs
+class ReplayDevice(object):
+
+    def __init__(self, address, session, speed=1.0, loop=False, serial=None):
+        self.bus = 'replay'
+        self.address = address
+        self.session = session
+        self.speed = speed
+        self.loop = loop
+        self.serial = serial
+
+    def connect(self):
+        return ReplayErg(self.session, self.speed, self.loop, self.serial)
+
+# replay devices for a list of log files ('synthetic' for a generated session),
+# each given its own serial
+def find(sources, speed=1.0, loop=False):
+    devices = []
+    serials = set()
+    for address, source in enumerate(sources):
+        if source == 'synthetic':
+            session = synthetic_session(erg_id=str(900000001 + address), seed=address)
+        else:
+            session = load_session(source)
+
+        serial = session['erg_id']
+        while serial in serials:
+            serial = str(int(serial) + 1) if str(serial).isdigit() else serial + "'"
+        serials.add(serial)
+
+        devices.append(ReplayDevice(address, session, speed, loop, serial))
+    return devices
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+# Shared memory hand-off between the erg monitor processes and the server.
+# Every monitor writes into its own single producer, single consumer ring, so
+# putting a message never blocks (usb polling can't be held up by slow clients)
+# and nothing goes through a pipe except a byte to wake the server up.
+#
+# The rings are lock free on x86, where stores from one process become visible
+# to another in the order they were made, so a slot's sequence number (stored
+# last) is only seen once its data is. Python has no memory fences, so on weakly
+# ordered processors (the ARM in a Raspberry Pi) each ring writes and reads its
+# slots and counters under a lock shared by the two processes instead: the
+# semaphore behind it synchronizes memory. The lock is only held to copy a slot,
+# never while the server is sending to clients.
+
+# ==============================================================================
+# IMPORTS
+# ==============================================================================
+
+import collections
+import ctypes
+import errno
+import marshal  # records are marshalled, messages are plain dicts, lists and numbers
+import os
+import platform
+import struct
+import threading
+import time
+from multiprocessing import Lock, RawArray, RawValue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # windows, the server checks the rings on a timer instead
+
+# ==============================================================================
+# CONSTANTS
+# ==============================================================================
+
+# every slot starts with a header, followed by the record data:
+#   uint32 sequence (position in the lane + 1, 0 while being written),
+#   uint32 order (of the message across both lanes), uint16 data length, uint16 flags
+SLOT_HEADER = struct.Struct('<IIHH')
+FLAG_MORE = 0x1     # the message continues in the next slot
+
+# event lane: guaranteed delivery, messages too big for a slot are split over several
+EVENT_SLOTS = 64
+EVENT_SLOT_SIZE = 1024
+
+# force lane: the oldest samples are overwritten when the server falls behind
+FORCE_SLOTS = 64
+FORCE_SLOT_SIZE = 512
+
+UINT32 = 0xFFFFFFFF
+
+# processors whose stores are seen by other processes in program order (see above)
+ORDERED_STORES = platform.machine().lower() in ('x86_64', 'amd64', 'i386', 'i486', 'i586', 'i686', 'x86')
+
+# ==============================================================================
+# RING BUFFERS
+# ==============================================================================
+
+# is order a before order b (allowing for wrap around)
+def before(a, b):
+    return (a - b) & UINT32 > 0x7FFFFFFF
+
+# fixed size slots in shared memory. a slot's sequence is cleared while it is
+# written, so a reader can tell if it was overwritten while being copied
+class Lane(object):
+
+    def __init__(self, slots, slot_size):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.capacity = slot_size - SLOT_HEADER.size
+        self.buffer = RawArray(ctypes.c_char, slots * slot_size)
+
+    def write(self, position, order, data, flags=0):
+        offset = (position % self.slots) * self.slot_size
+        start = offset + SLOT_HEADER.size
+        SLOT_HEADER.pack_into(self.buffer, offset, 0, order, len(data), flags)
+        self.buffer[start:start + len(data)] = data
+        SLOT_HEADER.pack_into(self.buffer, offset, (position + 1) & UINT32, order, len(data), flags)
+
+    # (order, data, flags) if the slot holds the record for position, otherwise
+    # None (not written yet, or overwritten before or while it was copied)
+    def read(self, position):
+        offset = (position % self.slots) * self.slot_size
+        sequence = (position + 1) & UINT32
+        header = SLOT_HEADER.unpack_from(self.buffer, offset)
+        if header[0] != sequence:
+            return None
+
+        start = offset + SLOT_HEADER.size
+        data = self.buffer[start:start + header[2]]
+        if SLOT_HEADER.unpack_from(self.buffer, offset)[0] != sequence:
+            return None
+        return header[1], data, header[3]
+
+# stands in for the lock on processors that don't need one
+class Unlocked(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+# the messages from one monitor process. put() and flush() are called by the
+# monitor, read() by the server. locked defaults to whether the processor needs it
+class MessageRing(object):
+
+    def __init__(self, wake_fd=None, locked=None):
+        self.lock = Lock() if (not ORDERED_STORES if locked is None else locked) else Unlocked()
+        self.events = Lane(EVENT_SLOTS, EVENT_SLOT_SIZE)
+        self.forces = Lane(FORCE_SLOTS, FORCE_SLOT_SIZE)
+        self.event_tail = RawValue(ctypes.c_uint32)     # written by the server
+        self.force_head = RawValue(ctypes.c_uint32)     # written by the monitor
+        self.wake_fd = wake_fd
+        self.closed = False
+
+        # monitor side
+        self.order = 0
+        self.event_head = 0
+        self.force_position = 0
+        self.spill = collections.deque()    # events waiting for room in the ring
+        self.dropped = 0
+
+        # server side
+        self.event_read = 0
+        self.force_read = 0
+        self.lost = 0
+
+    # queue a message without ever blocking. droppable messages go in the force
+    # lane, everything else is delivered (waiting in the spill if the ring is full)
+    def put(self, message, droppable=False):
+        data = marshal.dumps(message)
+
+        if droppable and len(data) <= self.forces.capacity:
+            # samples are dropped while events are waiting, so everything stays in order
+            if self.flush():
+                with self.lock:
+                    self.forces.write(self.force_position, self.nextOrder(), data)
+                    self.force_position += 1
+                    self.force_head.value = self.force_position & UINT32
+                self.wake()
+            else:
+                self.dropped += 1
+            return
+
+        if len(data) > self.events.capacity * self.events.slots:
+            raise ValueError("message too large for the ring ({} bytes)".format(len(data)))
+
+        self.spill.append(data)
+        self.flush()
+
+    # move spilled events into the ring while there is room, waiting up to
+    # timeout seconds for the server to make some. True once none are left
+    def flush(self, timeout=0):
+        deadline = time.time() + timeout
+        while True:
+            written = False
+            with self.lock:
+                while self.spill and self.writeEvent(self.spill[0]):
+                    self.spill.popleft()
+                    written = True
+
+            if written:
+                self.wake()
+            remaining = deadline - time.time()
+            if not self.spill or remaining <= 0:
+                return not self.spill
+            time.sleep(min(remaining, 0.01))
+
+    def writeEvent(self, data):
+        lane = self.events
+        chunks = [data[i:i + lane.capacity] for i in range(0, len(data), lane.capacity)]
+        used = (self.event_head - self.event_tail.value) & UINT32
+        if used + len(chunks) > lane.slots:
+            return False
+
+        # the first chunk is written last, so once it can be read they all can
+        order = self.nextOrder()
+        for index in reversed(range(len(chunks))):
+            lane.write(self.event_head + index, order, chunks[index], FLAG_MORE if index < len(chunks) - 1 else 0)
+        self.event_head += len(chunks)
+        return True
+
+    def nextOrder(self):
+        self.order = (self.order + 1) & UINT32
+        return self.order
+
+    def wake(self):
+        if self.wake_fd is None:
+            return
+        try:
+            os.write(self.wake_fd, b'\0')
+        except OSError as e:
+            # a full pipe is already a wake up
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    # append every message that is ready to out, in the order they were put
+    def read(self, out):
+        while True:
+            with self.lock:
+                # check the force lane first: an event put before a visible sample is always visible too
+                force = self.peekForce()
+                event = self.peekEvent()
+
+                if event is not None and (force is None or before(event[0], force[0])):
+                    self.event_read += event[2]
+                    self.event_tail.value = self.event_read & UINT32
+                    data = event[1]
+                elif force is not None:
+                    self.force_read += 1
+                    data = force[1]
+                else:
+                    return
+            out.append(marshal.loads(data))
+
+    def peekForce(self):
+        lane = self.forces
+        while True:
+            behind = (self.force_head.value - self.force_read) & UINT32
+            if behind == 0:
+                return None
+
+            # the monitor lapped us, skip to the oldest sample still there
+            if behind > lane.slots:
+                self.lost += behind - lane.slots
+                self.force_read += behind - lane.slots
+
+            record = lane.read(self.force_read)
+            if record is not None:
+                return record
+            self.force_read += 1
+            self.lost += 1
+
+    # (order, data, slots used) for the next event, None if there isn't one
+    def peekEvent(self):
+        record = self.events.read(self.event_read)
+        if record is None:
+            return None
+
+        order, data, flags = record
+        chunks = [data]
+        while flags & FLAG_MORE:
+            record = self.events.read(self.event_read + len(chunks))
+            if record is None:
+                return None
+            flags = record[2]
+            chunks.append(record[1])
+        return order, b''.join(chunks), len(chunks)
+
+# stands in for a MessageRing when the monitor runs in the server process
+# (single process mode), handing messages straight to the queue
+class LocalRing(object):
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.closed = False
+
+    def put(self, message, droppable=False):
+        self.queue.put(message, droppable)
+
+    def flush(self, timeout=0):
+        return True
+
+# ==============================================================================
+# SERVER SIDE QUEUE
+# ==============================================================================
+
+# collects the messages from every ring for the server (in place of a
+# multiprocessing.Queue), waking it through a pipe when there are new ones
+class RingQueue(object):
+
+    def __init__(self):
+        self.wake_read = self.wake_write = None
+        if fcntl is not None:
+            self.wake_read, self.wake_write = os.pipe()
+            for fd in (self.wake_read, self.wake_write):
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self.rings = ()
+        self.lock = threading.Lock()
+        self.local = collections.deque()    # put from the server process itself
+        self.ready = collections.deque()
+
+    # a ring for a new monitor process (create it before starting the process),
+    # or for a monitor thread in this process if local
+    def ring(self, local=False):
+        if local:
+            return LocalRing(self)
+
+        ring = MessageRing(self.wake_write)
+        with self.lock:
+            self.rings = self.rings + (ring,)
+        return ring
+
+    # the ring's monitor has stopped, forget it once everything in it has been read
+    def release(self, ring):
+        ring.closed = True
+        self.wake()
+
+    def fileno(self):
+        return self.wake_read
+
+    def wake(self):
+        if self.wake_write is None:
+            return
+        try:
+            os.write(self.wake_write, b'\0')
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def put(self, message, droppable=False):
+        self.local.append(message)
+        self.wake()
+
+    def empty(self):
+        if not self.ready:
+            self.collect()
+        return not self.ready
+
+    def get(self):
+        return self.ready.popleft()
+
+    def collect(self):
+        # clear the wake ups first, anything put after this wakes us again
+        if self.wake_read is not None:
+            try:
+                while os.read(self.wake_read, 4096):
+                    pass
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+        # what was put locally goes after what is in the rings: the supervisor's messages
+        # about a monitor it stopped (put once its ring was released) come after the
+        # monitor's own last ones. anything put after this waits for the next collect
+        local = []
+        while self.local:
+            local.append(self.local.popleft())
+
+        released = []
+        for ring in self.rings:
+            closed = ring.closed
+            ring.read(self.ready)
+            if closed:
+                released.append(ring)
+
+        self.ready.extend(local)
+
+        if released:
+            with self.lock:
+                self.rings = tuple(ring for ring in self.rings if ring not in released)
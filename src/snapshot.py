@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# The latest state of every erg, kept by the server from the messages going
+# past, so a client that connects mid workout can be sent everything it missed
+# in one SNAPSHOT message: the erg's info, the current workout, the latest
+# monitor readings and its last few complete strokes.
+
+# ==============================================================================
+# IMPORTS
+# ==============================================================================
+
+import collections
+
+# ==============================================================================
+# CONSTANTS
+# ==============================================================================
+
+# complete strokes (STROKE_END) kept for each erg
+SNAPSHOT_STROKES = 10
+
+# ==============================================================================
+# SNAPSHOT CACHE
+# ==============================================================================
+
+class SnapshotCache(object):
+
+    def __init__(self, strokes=SNAPSHOT_STROKES):
+        self.strokes = strokes
+        self.ergs = {}  # state of each erg, by erg_id
+
+    # take what is new from a message on its way to the clients
+    def update(self, message):
+        msg_type = message['type']
+        content = message['content']
+        if not isinstance(content, dict) or content.get('erg_id') is None:
+            return
+        erg_id = str(content['erg_id'])
+
+        # the monitor stopped or the erg was unplugged, a restarted monitor sends it all again
+        if msg_type == "ERG_HEALTH" and 'error' in content:
+            self.ergs.pop(erg_id, None)
+            return
+
+        erg = self.ergs.get(erg_id)
+        if erg is None:
+            erg = self.ergs[erg_id] = { 'info': None, 'workout': None, 'monitor': None, 'health': None,
+                                        'strokes': collections.deque(maxlen=self.strokes) }
+
+        if msg_type == "ERG_INFO":
+            erg['info'] = content['erg']
+        elif msg_type == "ERG_HEALTH":
+            erg['health'] = content
+        elif msg_type == "WORKOUT_START" or msg_type == "WORKOUT_END":
+            erg['workout'] = { 'type': msg_type, 'content': content }
+            if msg_type == "WORKOUT_START":
+                erg['strokes'].clear()
+        elif msg_type == "STROKE_END" and self.strokes:
+            erg['strokes'].append(content)
+
+        if 'monitor' in content:
+            erg['monitor'] = content['monitor']
+
+    # SNAPSHOT content for the given erg ids (None for every erg):
+    #   { 'ergs': [{ 'erg_id', 'info' (ERG_INFO's erg), 'workout' (the last WORKOUT_START or
+    #   WORKOUT_END as { 'type', 'content' }), 'monitor', 'health' (the last ERG_HEALTH),
+    #   'strokes' (the last STROKE_ENDs' content, oldest first) }, ...] }
+    # anything not seen yet is null
+    def snapshot(self, erg_ids=None):
+        ergs = []
+        for erg_id in sorted(self.ergs.keys()):
+            if erg_ids is not None and erg_id not in erg_ids:
+                continue
+            erg = self.ergs[erg_id]
+            ergs.append({ 'erg_id': erg_id, 'info': erg['info'], 'workout': erg['workout'], 'monitor': erg['monitor'],
+                          'health': erg['health'], 'strokes': list(erg['strokes']) })
+        return { 'ergs': ergs }
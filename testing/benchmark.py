@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+
+# Benchmarks for the hot path from the erg to the clients, run offline against
+# simulated ergs (pyrow.usbsim): the CSAFE codec, the monitor loop, message
+# serialization, the hand-off from the monitors to the server, and websocket
+# broadcast to local clients. Results are printed as json, so runs can be saved
+# and compared to catch regressions.
+#
+#   python testing/benchmark.py [--quick] [--only codec,broadcast] [--output results.json]
+
+# ==============================================================================
+# IMPORTS
+# ==============================================================================
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import base64
+import json
+import platform
+import re
+import select
+import socket
+import struct
+import threading
+import time
+from multiprocessing import Process, Pipe
+from optparse import OptionParser
+from timeit import default_timer as timer
+
+import pyrow.pyrow as pyrow
+from pyrow import csafe_cmd, usbsim
+import ergserver
+from ringqueue import RingQueue, MessageRing
+
+# ==============================================================================
+# CONSTANTS
+# ==============================================================================
+
+SECTIONS = ('codec', 'monitor', 'serialization', 'handoff', 'broadcast')
+
+# the queries each pyrow call sends
+COMMAND_SETS = {
+    'getMonitor': pyrow.monitorcmd,
+    'getMonitor+forceplot': pyrow.monitorcmd + pyrow.forceplotcmd,
+    'getForcePlot': pyrow.forceplotcmd,
+    'getStroke': pyrow.strokecmd,
+    'getWorkout': pyrow.workoutcmd,
+}
+
+CLIENT_COUNTS = (1, 10, 100)
+
+# seconds spent timing each function
+MEASURE_TIME = 1.0
+QUICK_MEASURE_TIME = 0.2
+
+# ==============================================================================
+# HELPERS
+# ==============================================================================
+
+# calls per second and microseconds per call of fn, timed in batches for at least seconds
+def measure(fn, seconds):
+    batch = 1
+    calls = 0
+    elapsed = 0.0
+    while elapsed < seconds:
+        start = timer()
+        for _ in range(batch):
+            fn()
+        taken = timer() - start
+        calls += batch
+        elapsed += taken
+        if taken < 0.01:
+            batch *= 2
+    return { 'ops_per_sec': round(calls / elapsed, 1), 'us_per_op': round(elapsed / calls * 1e6, 3) }
+
+# p50/p99/max (and p95) of a list of seconds, in milliseconds
+def percentiles(samples):
+    if not samples:
+        return { 'count': 0 }
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+    return { 'count': len(samples), 'p50_ms': round(pick(50) * 1000, 3), 'p95_ms': round(pick(95) * 1000, 3),
+             'p99_ms': round(pick(99) * 1000, 3), 'max_ms': round(samples[-1] * 1000, 3) }
+
+# a simulated erg part way through a drive, so force plot responses have samples in them
+def rowing_erg(**options):
+    device = usbsim.Device(framegap=0, step=0.01, **options)
+    device.row()
+    device.clock += 0.1
+    return device
+
+# a response from the simulated erg to a frame
+def response_to(device, frame):
+    device.write(pyrow.outEndpoint, frame)
+    return device.read(pyrow.inEndpoint, len(frame))
+
+# typical messages, built from a simulated erg's readings
+def sample_messages():
+    erg = pyrow.pyrow(rowing_erg())
+    monitor = erg.getMonitor()
+    stroke = erg.getStroke()
+    workout = erg.getWorkout()
+    forceplot = [int(200 * (4. * (n + .5) / 60) * (1. - (n + .5) / 60)) for n in range(60)]
+    return {
+        'STROKE_FORCE': { 'erg_id': '300000001', 'stroke_id': 12, 'time': stroke['time'], 'forceplot': stroke['forceplot'] },
+        'STROKE_END': { 'erg_id': '300000001', 'stroke_id': 12, 'monitor': monitor, 'forceplot': forceplot },
+        'WORKOUT_START': { 'erg_id': '300000001', 'monitor': monitor, 'workout': workout },
+    }
+
+# swallows output (the monitor and the server print as they go)
+class Quiet(object):
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+# ==============================================================================
+# CSAFE CODEC
+# ==============================================================================
+
+# encoding, decoding and whole round trips through pyrow for each poll
+def bench_codec(seconds):
+    results = {}
+    for name, commands in sorted(COMMAND_SETS.items()):
+        device = rowing_erg()
+        frame = csafe_cmd.Compile(commands)
+        response = response_to(device, frame)
+        erg = pyrow.pyrow(rowing_erg())
+        erg.framegap = 0.   # the simulated erg doesn't check one
+
+        results[name] = {
+            'frame_bytes': len(frame),
+            'write': measure(lambda: csafe_cmd.Write(list(commands)), seconds),
+            'compile_cached': measure(lambda: csafe_cmd.Compile(commands), seconds),
+            'read': measure(lambda: csafe_cmd.Read(response), seconds),
+            'send': measure(lambda: erg.send(frame), seconds),
+        }
+    return results
+
+# ==============================================================================
+# MONITOR LOOP
+# ==============================================================================
+
+# collects what a monitor queues
+class CountingQueue(object):
+
+    def __init__(self):
+        self.counts = {}
+
+    def put(self, message, droppable=False):
+        self.counts[message['type']] = self.counts.get(message['type'], 0) + 1
+
+    def flush(self, timeout=0):
+        return True
+
+# polls and messages per second from monitor_erg rowing on a simulated erg, without
+# waiting between polls or for the frame gap
+def bench_monitor(seconds):
+    device = usbsim.Device(framegap=0, step=0.01)
+    device.row()
+    queue = CountingQueue()
+    stopped = threading.Event()
+    intervals = dict((state, 0.0) for state in ergserver.POLL_INTERVALS)
+
+    with Quiet():
+        erg = pyrow.pyrow(device)
+        erg.framegap = 0.   # getErg keeps it, the simulated erg reports none
+        monitor = threading.Thread(target=ergserver.monitor_erg, args=(queue, erg, intervals, stopped))
+        monitor.start()
+        time.sleep(seconds)
+        stopped.set()
+        monitor.join()
+
+    return { 'frames_per_sec': round(device.frames / seconds, 1),
+             'messages_per_sec': round(sum(queue.counts.values()) / seconds, 1),
+             'strokes': queue.counts.get('STROKE_END', 0) }
+
+# ==============================================================================
+# SERIALIZATION
+# ==============================================================================
+
+# the cost of a message on its way out: queue_message, the ring record, then json and binary payloads
+def bench_serialization(seconds):
+    results = {}
+    for msg_type, content in sorted(sample_messages().items()):
+        message = { 'type': msg_type, 'content': content, 'time': time.time() }
+        droppable = msg_type in ergserver.DROPPABLE_TYPES
+        ring = MessageRing()
+        out = []
+        sink = CountingQueue()
+
+        def ring_round_trip():
+            ring.put(message, droppable)
+            ring.read(out)
+            del out[:]
+
+        results[msg_type] = {
+            'queue_message': measure(lambda: ergserver.queue_message(sink, content, msg_type, log=False), seconds),
+            'ring': measure(ring_round_trip, seconds),
+            'json': measure(lambda: json.dumps(message), seconds),
+            'json_bytes': len(json.dumps(message)),
+        }
+        if ergserver.encode_binary(message) is not None:
+            results[msg_type]['binary'] = measure(lambda: ergserver.encode_binary(message), seconds)
+            results[msg_type]['binary_bytes'] = len(ergserver.encode_binary(message))
+    return results
+
+# ==============================================================================
+# QUEUE HAND-OFF
+# ==============================================================================
+
+def stamped(content, seq):
+    return { 'type': 'STROKE_FORCE', 'content': dict(content, seq=seq, sent=time.time()), 'time': 0 }
+
+def produce(ring, content, count, interval):
+    for seq in range(count):
+        ring.put(stamped(content, seq), True)
+        time.sleep(interval)
+    ring.flush(1.0)
+
+# latency from a monitor putting a message to the server picking it up, from a
+# monitor process (shared memory ring) and a monitor thread (single process mode)
+def bench_handoff(count, interval=0.001):
+    content = sample_messages()['STROKE_FORCE']
+    results = {}
+    for mode in ('process', 'thread'):
+        queue = RingQueue()
+        ring = queue.ring(local=(mode == 'thread'))
+        if mode == 'thread':
+            producer = threading.Thread(target=produce, args=(ring, content, count, interval))
+        else:
+            producer = Process(target=produce, args=(ring, content, count, interval))
+        producer.start()
+
+        latencies = []
+        deadline = time.time() + count * interval + 5.0
+        while len(latencies) < count and time.time() < deadline:
+            select.select([queue.fileno()], [], [], 0.1)
+            while not queue.empty():
+                message = queue.get()
+                latencies.append(time.time() - message['content']['sent'])
+        producer.join()
+
+        results[mode] = percentiles(latencies)
+        results[mode]['lost'] = count - len(latencies)
+    return results
+
+# ==============================================================================
+# BROADCAST
+# ==============================================================================
+
+SEQ = re.compile(r'"seq": (\d+)')
+
+# a websocket client that only reads, parsing the frames the server sends
+class BenchClient(object):
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        key = base64.b64encode(os.urandom(16))
+        self.sock.sendall('GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                          'Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n' % key)
+        self.buffer = ''
+        while '\r\n\r\n' not in self.buffer:
+            self.buffer += self.sock.recv(4096)
+        self.buffer = self.buffer[self.buffer.index('\r\n\r\n') + 4:]
+        self.sock.setblocking(0)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    # the payloads of every complete frame received so far
+    def receive(self):
+        try:
+            self.buffer += self.sock.recv(262144)
+        except socket.error:
+            pass
+
+        payloads = []
+        while len(self.buffer) >= 2:
+            length = ord(self.buffer[1]) & 0x7F
+            start = 2
+            if length == 126:
+                if len(self.buffer) < 4:
+                    break
+                length = struct.unpack('!H', self.buffer[2:4])[0]
+                start = 4
+            elif length == 127:
+                if len(self.buffer) < 10:
+                    break
+                length = struct.unpack('!Q', self.buffer[2:10])[0]
+                start = 10
+            if len(self.buffer) < start + length:
+                break
+            payloads.append(self.buffer[start:start + length])
+            self.buffer = self.buffer[start + length:]
+        return payloads
+
+    def close(self):
+        self.sock.close()
+
+# an ErgServer in its own process, as it runs for real, reading from the queue
+def serve(queue, connection):
+    sys.stdout = open(os.devnull, 'w')
+    server = ergserver.ErgServer('127.0.0.1', 0, ergserver.ErgSocket, queue)
+    connection.send(server.serversocket.getsockname()[1])
+    server.serveforever()
+
+# read from every client until each has count messages or timeout, returning
+# the arrival times of each message by client
+def receive_all(clients, count, timeout):
+    arrivals = [{} for _ in clients]
+    deadline = time.time() + timeout
+    pending = set(range(len(clients)))
+    while pending and time.time() < deadline:
+        readable = select.select([clients[n] for n in pending], [], [], 0.1)[0]
+        now = time.time()
+        for client in readable:
+            n = clients.index(client)
+            for payload in client.receive():
+                match = SEQ.search(payload)
+                if match:
+                    arrivals[n][int(match.group(1))] = now
+            if len(arrivals[n]) >= count:
+                pending.discard(n)
+    return arrivals
+
+# fan-out to local json clients: messages per second in a burst of guaranteed
+# (STROKE_END) messages, and latency from the monitor to the client with force
+# samples (STROKE_FORCE) at rate a second
+def bench_broadcast(client_counts, burst, latency_count, rate):
+    messages = sample_messages()
+    results = {}
+    for client_count in client_counts:
+        queue = RingQueue()
+        ring = queue.ring()
+        parent, child = Pipe()
+        server = Process(target=serve, args=(queue, child))
+        server.daemon = True
+        server.start()
+        clients = []
+        try:
+            port = parent.recv()
+            clients = [BenchClient(port) for _ in range(client_count)]
+
+            # every client is connected once they all have the first message
+            seq = 0
+            ready = False
+            while not ready:
+                ring.put({ 'type': 'TXT', 'content': { 'seq': seq }, 'time': 0 })
+                arrivals = receive_all(clients, 1, 0.5)
+                ready = all(seq in received for received in arrivals)
+                seq += 1
+
+            # throughput
+            start = time.time()
+            for n in range(burst):
+                ring.put({ 'type': 'STROKE_END', 'content': dict(messages['STROKE_END'], seq=n), 'time': 0 })
+            ring.flush(10.0)
+            arrivals = receive_all(clients, burst, 30.0)
+            received = sum(len(client_arrivals) for client_arrivals in arrivals)
+            elapsed = max(max(client_arrivals.values()) for client_arrivals in arrivals if client_arrivals) - start
+            size = len(json.dumps({ 'type': 'STROKE_END', 'content': dict(messages['STROKE_END'], seq=0), 'time': 0 }))
+
+            # latency, paced from another thread while the clients read
+            sent = {}
+            def pace():
+                for n in range(latency_count):
+                    sent[n] = time.time()
+                    ring.put({ 'type': 'STROKE_FORCE', 'content': dict(messages['STROKE_FORCE'], seq=n), 'time': 0 }, True)
+                    time.sleep(1.0 / rate)
+            producer = threading.Thread(target=pace)
+            producer.start()
+            latency_arrivals = receive_all(clients, latency_count, latency_count / float(rate) + 5.0)
+            producer.join()
+            latencies = [arrival - sent[n] for client_arrivals in latency_arrivals for n, arrival in client_arrivals.items() if n in sent]
+
+            results[str(client_count)] = {
+                'messages_per_sec': round(burst / elapsed, 1),
+                'frames_per_sec': round(received / elapsed, 1),
+                'mbytes_per_sec': round(received * size / elapsed / 1e6, 3),
+                'delivered': round(received / float(burst * client_count), 4),
+                'latency': dict(percentiles(latencies), rate=rate,
+                                delivered=round(len(latencies) / float(latency_count * client_count), 4)),
+            }
+        finally:
+            for client in clients:
+                client.close()
+            server.terminate()
+            server.join()
+    return results
+
+# ==============================================================================
+# MAIN
+# ==============================================================================
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--only", default='', type='string', action="store", dest="only", help="comma separated sections to run ({})".format(','.join(SECTIONS)))
+    parser.add_option("--clients", default=','.join(str(count) for count in CLIENT_COUNTS), type='string', action="store", dest="clients", help="client counts for the broadcast benchmark (1,10,100)")
+    parser.add_option("--quick", default=False, action="store_true", dest="quick", help="shorter runs, for a quick check")
+    parser.add_option("--output", default='', type='string', action="store", dest="output", help="write the results to this file as well")
+    (options, args) = parser.parse_args()
+
+    sections = options.only.split(',') if options.only else SECTIONS
+    for section in sections:
+        if section not in SECTIONS:
+            parser.error("unknown section '{}'".format(section))
+    try:
+        client_counts = [int(count) for count in options.clients.split(',')]
+    except ValueError:
+        parser.error("--clients must be a list of numbers")
+
+    seconds = QUICK_MEASURE_TIME if options.quick else MEASURE_TIME
+    scale = 5 if options.quick else 1
+
+    results = {}
+    for section in sections:
+        sys.stderr.write("running {}...\n".format(section))
+        if section == 'codec':
+            results[section] = bench_codec(seconds)
+        elif section == 'monitor':
+            results[section] = bench_monitor(seconds * 2)
+        elif section == 'serialization':
+            results[section] = bench_serialization(seconds)
+        elif section == 'handoff':
+            results[section] = bench_handoff(2000 // scale)
+        elif section == 'broadcast':
+            results[section] = bench_broadcast(client_counts, 2000 // scale, 1000 // scale, rate=500)
+
+    report = {
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': options.quick,
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == "__main__":
+    main()
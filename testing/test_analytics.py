@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+# The numpy and plain python stroke analytics have to agree exactly, since which
+# one a stroke goes through depends on how many other strokes ended with it.
+#
+#   python testing/test_analytics.py
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import random
+import unittest
+
+import analytics
+
+# force curves like the erg's, plus the odd ones (empty, one sample, flat, zeros)
+def force_curves(count, seed=0):
+    rand = random.Random(seed)
+    curves = [[], [0], [57], [0, 0, 0], [120] * 40]
+    while len(curves) < count:
+        samples = rand.randint(1, 120)
+        peak = rand.randint(1, 400)
+        curves.append([max(0, int(peak * (1 - abs(2.0 * i / samples - 1)) + rand.randint(-15, 15))) for i in range(samples)])
+    return curves
+
+@unittest.skipIf(analytics.numpy is None, "numpy isn't installed")
+class BatchMetricsTest(unittest.TestCase):
+
+    def test_numpy_matches_python(self):
+        curves = force_curves(5000)
+        for curve, metrics in zip(curves, analytics.numpy_metrics(curves)):
+            self.assertEqual(metrics, analytics.python_metrics(curve), curve)
+
+    def test_batch_sizes_match(self):
+        curves = force_curves(analytics.NUMPY_MIN_BATCH, seed=1)
+        self.assertEqual(analytics.batch_metrics(curves), analytics.batch_metrics(curves[:1]) + analytics.batch_metrics(curves[1:]))
+
+    def test_types(self):
+        for metrics in analytics.numpy_metrics(force_curves(10)):
+            self.assertTrue(all(type(value) in (int, float) for value in metrics.values()), metrics)
+
+if __name__ == '__main__':
+    unittest.main()
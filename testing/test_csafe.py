@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# CSAFE frames whose checksum is one of the frame flag values (0xF0-0xF3) have
+# the checksum byte stuffed like any other: Write has to send it stuffed for the
+# monitor to accept the frame, and Read has to unstuff it in responses. Checked
+# against the simulated monitor (pyrow.usbsim), which parses frames byte for byte.
+#
+#   python testing/test_csafe.py
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import unittest
+from functools import reduce
+from operator import xor
+
+import pyrow.pyrow as pyrow
+import pyrow.csafe_cmd as csafe_cmd
+import pyrow.csafe_dic as csafe_dic
+import pyrow.usbsim as usbsim
+
+FLAGS = range(0xF0, 0xF4)
+
+# the frame bytes from the start flag to the stop flag
+def framed(frame):
+    frame = list(bytearray(frame))
+    start = frame.index(csafe_dic.Standard_Frame_Start_Flag)
+    return frame[start:frame.index(csafe_dic.Stop_Frame_Flag, start) + 1]
+
+# a SETPROGRAM command whose frame checksum is the given value
+def program_command(checksum):
+    for program in range(256):
+        contents = usbsim.unstuff(bytearray(framed(csafe_cmd.Write(['CSAFE_SETPROGRAM_CMD', program, 0]))[1:-1]))
+        if contents[-1] == checksum:
+            return ['CSAFE_SETPROGRAM_CMD', program, 0], contents[:-1]
+    raise AssertionError("no program gives checksum {:#x}".format(checksum))
+
+class ChecksumStuffingTest(unittest.TestCase):
+
+    def test_write_stuffs_checksum(self):
+        for checksum in FLAGS:
+            command, contents = program_command(checksum)
+            self.assertEqual(reduce(xor, contents, 0), checksum)
+
+            # ... contents, stuffing flag, low bits of the checksum, stop flag
+            frame = framed(csafe_cmd.Write(list(command)))
+            self.assertEqual(frame[-3:], [csafe_dic.Byte_Stuffing_Flag, checksum & 0x3, csafe_dic.Stop_Frame_Flag])
+            self.assertEqual(bytearray(frame[1:-3]), usbsim.stuff(contents))
+            self.assertEqual(list(bytearray(csafe_cmd.Compile(command))), list(csafe_cmd.Write(list(command))))
+
+    def test_monitor_accepts_stuffed_checksum(self):
+        device = usbsim.Device(framegap=0)
+        erg = pyrow.pyrow(device)
+        for checksum in FLAGS:
+            command, contents = program_command(checksum)
+            response = erg.send(csafe_cmd.Compile(command))
+            self.assertIn('CSAFE_GETSTATUS_CMD', response)
+        self.assertEqual((device.frames, device.dropped, device.rejected), (len(FLAGS), 0, 0))
+
+    def test_read_unstuffs_checksum(self):
+        # heart rates until every flag value has turned up as a response checksum
+        device = usbsim.Device(framegap=0)
+        frame = csafe_cmd.Compile(['CSAFE_GETHRCUR_CMD'])
+        seen = set()
+        for heartrate in range(256):
+            device.row(heartrate=heartrate)
+            device.write(pyrow.outEndpoint, frame)
+            response = device.read(pyrow.inEndpoint, len(frame))
+
+            tail = framed(response)[-3:]
+            if tail[0] == csafe_dic.Byte_Stuffing_Flag:
+                seen.add(0xF0 | tail[1])
+                self.assertEqual(csafe_cmd.Read(response)['CSAFE_GETHRCUR_CMD'], [heartrate])
+        self.assertEqual(seen, set(FLAGS))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# A MessageRing written by one process and read by another, as the monitors
+# and the server use it: the force lane being lapped, events spilling while the
+# event lane is full, events split over several slots, and both at once. Each
+# test runs lock free (as on x86) and locked (as on weakly ordered processors).
+#
+#   python testing/test_ringqueue.py
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import time
+import unittest
+from multiprocessing import Event, Process
+
+import ringqueue
+from ringqueue import MessageRing, EVENT_SLOTS, FORCE_SLOTS
+
+# a message that can be checked for damage: its payload is made from its seq
+def message(kind, seq, size):
+    return { 'type': kind, 'content': { 'seq': seq, 'payload': ('%08d' % seq) * (size // 8) } }
+
+def intact(msg):
+    content = msg['content']
+    return content['payload'] == ('%08d' % content['seq']) * (len(content['payload']) // 8)
+
+def put_forces(ring, count, done):
+    for seq in range(count):
+        ring.put(message('STROKE_FORCE', seq, 200), True)
+    done.set()
+
+def put_events(ring, count, size, done):
+    for seq in range(count):
+        ring.put(message('STROKE_END', seq, size))
+    ring.flush(30.0)
+    done.set()
+
+# events of 1 to 4 slots and force samples, as fast as possible
+def put_mixed(ring, count, done):
+    for seq in range(count):
+        if seq % 5 == 0:
+            ring.put(message('STROKE_END', seq, 100 + (seq * 37) % 3500))
+        else:
+            ring.put(message('STROKE_FORCE', seq, 200), True)
+    ring.flush(30.0)
+    done.set()
+
+# read until done is set and nothing is left (or the timeout passes)
+def read_all(ring, done, timeout=30.0):
+    out = []
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        finished = done.is_set()
+        ring.read(out)
+        if finished:
+            ring.read(out)
+            break
+        time.sleep(0.001)
+    return out
+
+class MessageRingTest(unittest.TestCase):
+
+    locked = False
+
+    def run_writer(self, target, *args):
+        ring = MessageRing(locked=self.locked)
+        done = Event()
+        process = Process(target=target, args=(ring,) + args + (done,))
+        process.start()
+        return ring, done, process
+
+    def test_force_lane_lapped(self):
+        ring, done, process = self.run_writer(put_forces, FORCE_SLOTS * 4)
+        done.wait(30.0)
+        process.join()
+
+        out = read_all(ring, done)
+        seqs = [msg['content']['seq'] for msg in out]
+        self.assertEqual(seqs, list(range(FORCE_SLOTS * 3, FORCE_SLOTS * 4)))   # the newest lap survives
+        self.assertEqual(ring.lost, FORCE_SLOTS * 3)
+        self.assertTrue(all(intact(msg) for msg in out))
+
+    def test_event_lane_spills(self):
+        count = EVENT_SLOTS * 5
+        ring, done, process = self.run_writer(put_events, count, 100)
+        time.sleep(0.2)     # let the writer fill the lane and spill
+        out = read_all(ring, done)
+        process.join()
+
+        self.assertEqual([msg['content']['seq'] for msg in out], list(range(count)))
+        self.assertTrue(all(intact(msg) for msg in out))
+
+    def test_multi_slot_events(self):
+        ring, done, process = self.run_writer(put_events, 100, 3000)   # 3 slots each
+        out = read_all(ring, done)
+        process.join()
+
+        self.assertEqual([msg['content']['seq'] for msg in out], list(range(100)))
+        self.assertTrue(all(intact(msg) for msg in out))
+
+    def test_concurrent(self):
+        count = 20000
+        ring, done, process = self.run_writer(put_mixed, count)
+        out = read_all(ring, done)
+        process.join()
+
+        # every event arrives, samples may be lost, everything in order and undamaged
+        seqs = [msg['content']['seq'] for msg in out]
+        self.assertEqual(seqs, sorted(seqs))
+        self.assertEqual([msg['content']['seq'] for msg in out if msg['type'] == 'STROKE_END'], list(range(0, count, 5)))
+        self.assertTrue(all(intact(msg) for msg in out))
+
+class LockedMessageRingTest(MessageRingTest):
+
+    locked = True
+
+    def test_default(self):
+        self.assertEqual(isinstance(MessageRing().lock, ringqueue.Unlocked), ringqueue.ORDERED_STORES)
+
+if __name__ == '__main__':
+    unittest.main()